@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import json
+import multiprocessing
+import random
+import statistics
+import time
+
+import game
+import navigate
+
+# Policies
+def random_inputs(seed):
+    rng = random.Random(seed)
+    state = game.INPUT_RIGHT
+
+    while True:
+        r = rng.random()
+
+        if r < 0.02:
+            state = game.INPUT_LEFT
+        elif r < 0.10:
+            state = game.INPUT_RIGHT
+        elif r < 0.11:
+            state = 0
+
+        if rng.random() < 0.08:
+            yield state | game.INPUT_JUMP
+        else:
+            yield state
+
+def make_inputs(kind, source):
+    if kind == "script":
+        return game.read_input_script(source)
+    else:
+        return random_inputs(source)
+
+# Jobs
+def run_job(job):
+    world, kind, source, max_frames = job
+
+    if kind == "bot":
+        sim = game.Simulation(world, None)
+        sim.inputs = navigate.Bot(navigate.load_graph(world)).inputs(sim)
+    else:
+        sim = game.Simulation(world, make_inputs(kind, source))
+
+    outcome = sim.run(max_frames)
+
+    return {"world": world,
+            "input": kind + ":" + str(source),
+            "outcome": outcome,
+            "frames": sim.frames,
+            "deaths": sim.deaths,
+            "score": sim.hero.score,
+            "fps": sim.fps()}
+
+def make_jobs(worlds, scripts, random_runs, seed, max_frames, bot=False):
+    jobs = []
+
+    for world in worlds:
+        if bot:
+            jobs.append((world, "bot", 0, max_frames))
+
+        for script in scripts:
+            jobs.append((world, "script", script, max_frames))
+
+        for n in range(random_runs):
+            jobs.append((world, "random", seed + n, max_frames))
+
+    return jobs
+
+def summarize(results):
+    summary = {}
+
+    for world in sorted(set(r["world"] for r in results)):
+        runs = [r for r in results if r["world"] == world]
+        completed = [r for r in runs if r["outcome"] == "completed"]
+
+        summary[world] = {"runs": len(runs),
+                          "completed": len(completed),
+                          "game_overs": len([r for r in runs if r["outcome"] == "game over"]),
+                          "mean_deaths": statistics.mean(r["deaths"] for r in runs),
+                          "mean_score": statistics.mean(r["score"] for r in runs),
+                          "max_score": max(r["score"] for r in runs),
+                          "min_frames_to_exit": min((r["frames"] for r in completed), default=None),
+                          "median_frames_to_exit": statistics.median([r["frames"] for r in completed]) if completed else None}
+
+    return summary
+
+def print_summary(summary, frames, elapsed):
+    print("%-26s %6s %9s %10s %7s %7s %10s %10s" % ("world", "runs", "completed", "game overs", "deaths", "score", "best exit", "median exit"))
+
+    for world, s in summary.items():
+        print("%-26s %6d %9d %10d %7.2f %7.1f %10s %10s" % (world, s["runs"], s["completed"], s["game_overs"],
+                                                         s["mean_deaths"], s["mean_score"],
+                                                         s["min_frames_to_exit"], s["median_frames_to_exit"]))
+
+    print("Simulated %d frames in %.2f s (%.0f frames per second)" % (frames, elapsed, frames / max(elapsed, 1e-9)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many headless playthroughs in parallel and summarize them.")
+    parser.add_argument("worlds", nargs="*", default=game.levels,
+                        help="world files or glob patterns (default: the built-in levels)")
+    parser.add_argument("--scripts", nargs="*", default=[],
+                        help="input scripts to play on every world")
+    parser.add_argument("--random", type=int, default=0,
+                        help="number of seeded random playthroughs per world")
+    parser.add_argument("--bot", action="store_true",
+                        help="also play every world with the shortest-path bot from navigate.py")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="first seed for random playthroughs")
+    parser.add_argument("--max-frames", type=int, default=60 * game.FPS * 5,
+                        help="frame limit for each playthrough")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write every result and the summary to FILE")
+    args = parser.parse_args()
+
+    worlds = []
+
+    for pattern in args.worlds:
+        worlds.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    jobs = make_jobs(worlds, args.scripts, args.random, args.seed, args.max_frames, args.bot)
+
+    if len(jobs) == 0:
+        parser.error("nothing to run, give --scripts, --random and/or --bot")
+
+    start = time.perf_counter()
+
+    with multiprocessing.Pool(args.processes) as pool:
+        results = list(pool.imap_unordered(run_job, jobs, chunksize=1))
+
+    elapsed = time.perf_counter() - start
+    results.sort(key=lambda r: (r["world"], r["input"]))
+    summary = summarize(results)
+
+    print_summary(summary, sum(r["frames"] for r in results), elapsed)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"results": results, "summary": summary}, f, indent=2)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Drawing is measured without a real window
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import game
+
+LOAD_REPEATS = 5
+SIM_FRAMES = 3000
+DRAW_FRAMES = 300
+
+# Lower is better for everything except ticks_per_sec
+HIGHER_IS_BETTER = ["ticks_per_sec"]
+
+# Synthetic levels
+def read_world(file_path):
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+def spawn_lists(map_data):
+    return [key for key, value in map_data.items()
+            if isinstance(value, list) and key not in ['background-color', 'start', 'exit']]
+
+def make_wide(map_data, copies=10):
+    wide = dict(map_data)
+    width = map_data['width']
+
+    for key in spawn_lists(map_data):
+        wide[key] = [[item[0] + n * width] + item[1:] for n in range(copies) for item in map_data[key]]
+
+    wide['width'] = width * copies
+    wide['exit'] = [[item[0] + (copies - 1) * width] + item[1:] for item in map_data['exit']]
+
+    return wide
+
+def make_dense(map_data, width=216):
+    dense = dict(map_data)
+
+    for key in spawn_lists(map_data):
+        dense[key] = []
+
+    dense['width'] = width
+    dense['start'] = [1, 7]
+    dense['blocks'] = [[x, y, "GC" if y == 9 else "GMT"] for x in range(width) for y in [8, 9]]
+    dense['blocks'] += [[x, y, "GF"] for x in range(4, width) for y in range(2, 7) if (x + y) % 3 == 0]
+    dense['coins'] = [[x, 1] for x in range(4, width, 2)]
+    dense['exit'] = [[width - 2, 7]]
+
+    return dense
+
+def make_crowd(map_data, copies=2):
+    crowd = make_wide(map_data, copies)
+    width = crowd['width']
+
+    crowd['snails'] = [[x, 8] for x in range(8, width, 2)][:300]
+    crowd['slimeBlocks'] = [[x, 8] for x in range(9, width, 2)][:150]
+    crowd['bees'] = [[x, 5] for x in range(10, width, 1)][:150]
+
+    return crowd
+
+def make_stress_levels(directory, template=game.levels[0]):
+    map_data = read_world(template)
+    stress = {"stress-wide": make_wide(map_data),
+              "stress-dense": make_dense(map_data),
+              "stress-crowd": make_crowd(map_data)}
+    paths = {}
+
+    for name, data in stress.items():
+        paths[name] = os.path.join(directory, name + ".json")
+
+        with open(paths[name], 'w') as f:
+            json.dump(data, f)
+
+    return paths
+
+# Measurements
+def scripted_inputs():
+    frame = 0
+
+    while True:
+        if frame % 45 == 0:
+            yield game.INPUT_RIGHT | game.INPUT_JUMP
+        else:
+            yield game.INPUT_RIGHT
+
+        frame += 1
+
+def measure_load(file_path):
+    times = []
+
+    for n in range(LOAD_REPEATS):
+        start = time.perf_counter()
+        game.Level(file_path)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times) * 1000
+
+def measure_ticks(file_path):
+    frames = 0
+    elapsed = 0
+
+    # Start over whenever a run ends early so every case simulates the same number of frames
+    while frames < SIM_FRAMES:
+        sim = game.Simulation(file_path, scripted_inputs())
+        sim.run(SIM_FRAMES - frames)
+
+        frames += sim.frames
+        elapsed += sim.elapsed
+
+    return frames / elapsed
+
+def measure_draw(file_path):
+    game.sound_on = False
+
+    g = game.Game()
+    g.start(file_path)
+    g.stage = game.Game.PLAYING
+
+    inputs = scripted_inputs()
+    times = []
+
+    for n in range(DRAW_FRAMES):
+        g.apply_input(next(inputs))
+        g.update()
+
+        start = time.perf_counter()
+        g.draw()
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+
+    return statistics.median(times) * 1000, times[int(len(times) * 0.95)] * 1000
+
+def run_case(case):
+    name, file_path = case
+
+    load_ms = measure_load(file_path)
+    ticks_per_sec = measure_ticks(file_path)
+
+    # tracemalloc slows everything down, so memory gets its own shorter run
+    tracemalloc.start()
+    game.Simulation(file_path, scripted_inputs()).run(SIM_FRAMES // 10)
+    peak_py = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    draw_ms, draw_p95_ms = measure_draw(file_path)
+
+    return name, {"load_ms": load_ms,
+                  "ticks_per_sec": ticks_per_sec,
+                  "draw_ms": draw_ms,
+                  "draw_p95_ms": draw_p95_ms,
+                  "peak_python_kb": peak_py / 1024,
+                  "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def run_all(cases):
+    # Each case runs alone in a fresh process so peak memory and caches don't leak between them
+    context = multiprocessing.get_context("spawn")
+    results = {}
+
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for name, metrics in pool.imap(run_case, cases):
+            results[name] = metrics
+            print("%-16s %s" % (name, "  ".join("%s=%.1f" % item for item in metrics.items())), file=sys.stderr)
+
+    return results
+
+# Baselines
+def compare(results, baseline, tolerance):
+    regressions = []
+
+    print("%-16s %-15s %12s %12s %9s" % ("case", "metric", "baseline", "now", "change"))
+
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+
+            if old is None or old == 0:
+                continue
+
+            change = (value - old) / old
+
+            if metric in HIGHER_IS_BETTER:
+                worse = change < -tolerance
+            else:
+                worse = change > tolerance
+
+            print("%-16s %-15s %12.2f %12.2f %+8.1f%% %s" % (name, metric, old, value, change * 100, "REGRESSION" if worse else ""))
+
+            if worse:
+                regressions.append((name, metric))
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark level loading, simulation and drawing.")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results as JSON to FILE (usable as a baseline later)")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare against results saved with --output and exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed relative slowdown before a metric counts as a regression")
+    parser.add_argument("--only", nargs="*",
+                        help="only run these cases (e.g. world-1 stress-crowd)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cases = [(os.path.splitext(os.path.basename(path))[0], path) for path in game.levels]
+        cases += sorted(make_stress_levels(directory).items())
+
+        if args.only:
+            cases = [case for case in cases if case[0] in args.only]
+
+        results = run_all(cases)
+
+    report = {"python": platform.python_version(),
+              "pygame": game.pygame.version.ver,
+              "machine": platform.machine(),
+              "results": results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        if len(compare(results, baseline['results'], args.tolerance)) > 0:
+            sys.exit(1)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import struct
+import sys
+import time
+
+import game
+
+# What reading a damaged cache can raise, the same as game.load_level_data allows for
+CACHE_ERRORS = (OSError, ValueError, KeyError, TypeError, IndexError, struct.error)
+
+def is_up_to_date(cache_path):
+    # A cache that can't be read is as stale as one compiled from an older world file
+    try:
+        return game.read_compiled_level(cache_path) is not None
+    except CACHE_ERRORS:
+        return False
+
+def compile_world(file_path, force=False):
+    cache_path = game.compiled_path(file_path)
+    start = time.perf_counter()
+
+    if force or not is_up_to_date(cache_path):
+        game.compile_level(file_path)
+        status = "compiled"
+    else:
+        status = "up to date"
+
+    elapsed = time.perf_counter() - start
+
+    return status, os.path.getsize(cache_path), elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile world JSON files into cached binary levels.")
+    parser.add_argument("worlds", nargs="*", default=game.levels,
+                        help="world JSON files to compile (default: every world in the game)")
+    parser.add_argument("--force", action="store_true",
+                        help="recompile even when the cached level is up to date")
+    args = parser.parse_args()
+
+    failed = False
+
+    for file_path in args.worlds:
+        try:
+            status, size, elapsed = compile_world(file_path, args.force)
+        except CACHE_ERRORS as e:
+            print("%s: %s" % (file_path, e), file=sys.stderr)
+            failed = True
+            continue
+
+        print("%-24s %-10s %8.1f KB %7.1f ms" % (file_path, status, size / 1024, elapsed * 1000))
+
+    if failed:
+        sys.exit(1)
@@ -1,11 +1,28 @@
 #!/usr/bin/env python3
 
+import argparse
+import array
+import collections
+import csv
+import hashlib
+import io
+import itertools
 import json
+import mmap
+import os
 import pygame
+import struct
 import sys
+import tempfile
+import threading
+import time
 
-pygame.mixer.pre_init()
-pygame.init()
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LAUNCH_TIME = time.perf_counter()
 
 # Window settings
 TITLE = "Beige Guy's Adventure"   
@@ -16,6 +33,11 @@ GRID_SIZE = 64
 
 # Options
 sound_on = True
+stream_levels = False
+batch_enemies = False # Needs NumPy
+dirty_rects = False
+max_frame_skip = 4 # Draws that may be skipped in a row to keep the game at full speed
+uncapped = False
 
 # Controls
 LEFT = pygame.K_LEFT
@@ -25,6 +47,20 @@ JUMP_2 = pygame.K_UP
 RUN = pygame.K_x
 PAUSE = pygame.K_p
 
+# Input states, one bit per control. LEFT and RIGHT are held keys, the rest are key presses this frame.
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_JUMP = 4
+INPUT_PAUSE = 8
+INPUT_KEY = 16
+INPUT_RESTART = 32
+INPUT_QUIT = 64
+
+INPUT_NAMES = {"LEFT": INPUT_LEFT,
+               "RIGHT": INPUT_RIGHT,
+               "JUMP": INPUT_JUMP,
+               "PAUSE": INPUT_PAUSE}
+
 # Levels
 levels = ["levels/world-1.json",
           "levels/world-2.json",
@@ -38,96 +74,292 @@ WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
 
 # Fonts
-FONT_SM = pygame.font.Font("assets/fonts/YanoneKaffeesatz-Regular.ttf", 32)
-FONT_MD = pygame.font.Font("assets/fonts/YanoneKaffeesatz-Regular.ttf", 64)
-FONT_LG = pygame.font.Font("assets/fonts/LoveYaLikeASister.ttf", 72)
+FONT_SM = ("assets/fonts/YanoneKaffeesatz-Regular.ttf", 32)
+FONT_MD = ("assets/fonts/YanoneKaffeesatz-Regular.ttf", 64)
+FONT_LG = ("assets/fonts/LoveYaLikeASister.ttf", 72)
+FONT_XS = ("assets/fonts/YanoneKaffeesatz-Regular.ttf", 20)
 
 # Helper functions
-def load_image(file_path, width=GRID_SIZE, height=GRID_SIZE):
-    img = pygame.image.load(file_path)
-    img = pygame.transform.scale(img, (width, height))
+class ImageCache():
 
-    return img
+    def __init__(self):
+        self.images = {}
+
+    def get(self, file_path, width=GRID_SIZE, height=GRID_SIZE, flip=False):
+        key = (file_path, width, height, flip)
+
+        if key not in self.images:
+            if flip:
+                img = pygame.transform.flip(self.get(file_path, width, height), 1, 0)
+            else:
+                img = pygame.image.load(file_path)
+                img = pygame.transform.scale(img, (width, height))
+
+                if pygame.display.get_surface() is not None:
+                    img = img.convert_alpha()
+
+            self.images[key] = img
+
+        return self.images[key]
+
+    def convert(self):
+        # Anything loaded before the window existed is still in file format
+        for key, img in self.images.items():
+            self.images[key] = img.convert_alpha()
+
+images = ImageCache()
+
+def load_image(file_path, width=GRID_SIZE, height=GRID_SIZE, flip=False):
+    return images.get(file_path, width, height, flip)
+
+fonts = {}
+sounds = {}
+
+def load_font(font):
+    if font not in fonts:
+        fonts[font] = pygame.font.Font(*font)
+
+    return fonts[font]
+
+def load_sound(file_path):
+    if file_path not in sounds:
+        sounds[file_path] = pygame.mixer.Sound(file_path)
+
+    return sounds[file_path]
 
 def play_sound(sound, loops=0, maxtime=0, fade_ms=0):
-    if sound_on:
-        if maxtime == 0:
-            sound.play(loops, maxtime, fade_ms)
-        else:
-            sound.play(loops, maxtime, fade_ms)
+    audio.play(sound, loops, maxtime, fade_ms)
 
 def play_music():
-    if sound_on:
-        pygame.mixer.music.play(-1)
-
-# Images
-hero_walk1 = load_image("assets/character/alienBeige_walk1.png")
-hero_walk2 = load_image("assets/character/alienBeige_walk2.png")
-hero_jump = load_image("assets/character/alienBeige_jump.png")
-hero_idle = load_image("assets/character/alienBeige_stand.png")
-hero_images = {"run": [hero_walk1, hero_walk2],
-               "jump": hero_jump,
-               "idle": hero_idle}
-
-block_images = {"SL": load_image("assets/tiles/snowLeft.png"),
-                "SMT": load_image("assets/tiles/snowMid_top.png"),
-                "SR": load_image("assets/tiles/snowRight.png"),
-                "SCR": load_image("assets/tiles/snowCliff_right.png"),
-                "SCL": load_image("assets/tiles/snowCliff_left.png"),
-                "ST": load_image("assets/tiles/snow_top.png"),
-                "SC": load_image("assets/tiles/snowCenter.png"),
-                "SF": load_image("assets/tiles/snow_float.png"),
-                "SP": load_image("assets/tiles/special.png"),
-                "GL": load_image("assets/tiles/grassLeft.png"),
-                "GMT": load_image("assets/tiles/grassMid_top.png"),
-                "GR": load_image("assets/tiles/grassRight.png"),
-                "GCR": load_image("assets/tiles/grassCliff_right.png"),
-                "GCL": load_image("assets/tiles/grassCliff_left.png"),
-                "GT": load_image("assets/tiles/grass_top.png"),
-                "GC": load_image("assets/tiles/grassCenter.png"),
-                "GF": load_image("assets/tiles/grass_float.png"),
-                "ML": load_image("assets/tiles/metalLeft.png"),
-                "MMT": load_image("assets/tiles/metalMid_top.png"),
-                "MR": load_image("assets/tiles/metalRight.png"),
-                "MCR": load_image("assets/tiles/metalCliff_right.png"),
-                "MCL": load_image("assets/tiles/metalCliff_left.png"),
-                "MT": load_image("assets/tiles/metal_top.png"),
-                "MC": load_image("assets/tiles/metalCenter.png"),
-                "MF": load_image("assets/tiles/metal_float.png"),
-                "PCL": load_image("assets/tiles/planetCliff_left.png"),
-                "PCR": load_image("assets/tiles/planetCliff_right.png"),
-                "PMT": load_image("assets/tiles/planetMid.png"),
-                "PC": load_image("assets/tiles/planetCenter.png")}
-
-coin_img = load_image("assets/coins/coinGold.png")
-gem_img = load_image("assets/coins/gemBlue.png")
-heart_img = load_image("assets/items/hudHeart_full.png")
-oneup_img = load_image("assets/items/hudPlayer_beige.png")
-reducedspeed_img = load_image("assets/items/hudPlayer_blue.png")
-exit_img = load_image("assets/items/signExit.png")
-lives_img = load_image("assets/items/life.png", 50, 50)
-star_img = load_image("assets/items/star.png")
-
-slimeBlock_img1 = load_image("assets/enemies/slimeBlock.png")
-slimeBlock_img2 = load_image("assets/enemies/slimeBlock_move.png")
-slimeBlock_images = [slimeBlock_img1, slimeBlock_img2]
-
-snail_walk1 = load_image("assets/enemies/snail.png")
-snail_walk2 = load_image("assets/enemies/snail_move.png")
-snail_images = [snail_walk1, snail_walk2]
-
-bee_fly1 = load_image("assets/enemies/bee.png")
-bee_fly2 = load_image("assets/enemies/bee_move.png")
-bee_images = [bee_fly1, bee_fly2]
-
-# Sounds
-JUMP_SOUND = pygame.mixer.Sound("assets/sounds/jump.wav")
-COIN_SOUND = pygame.mixer.Sound("assets/sounds/pickup_coin.wav")
-POWERUP_SOUND = pygame.mixer.Sound("assets/sounds/powerup.wav")
-HURT_SOUND = pygame.mixer.Sound("assets/sounds/hurt.ogg")
-DIE_SOUND = pygame.mixer.Sound("assets/sounds/death.wav")
-LEVELUP_SOUND = pygame.mixer.Sound("assets/sounds/level_up.wav")
-GAMEOVER_SOUND = pygame.mixer.Sound("assets/sounds/game_over.wav")
+    audio.play_music()
+
+# Images (loaded through the image cache the first time something uses them)
+hero_images = {"run": ["assets/character/alienBeige_walk1.png", "assets/character/alienBeige_walk2.png"],
+               "jump": "assets/character/alienBeige_jump.png",
+               "idle": "assets/character/alienBeige_stand.png"}
+
+block_images = {"SL": "assets/tiles/snowLeft.png",
+                "SMT": "assets/tiles/snowMid_top.png",
+                "SR": "assets/tiles/snowRight.png",
+                "SCR": "assets/tiles/snowCliff_right.png",
+                "SCL": "assets/tiles/snowCliff_left.png",
+                "ST": "assets/tiles/snow_top.png",
+                "SC": "assets/tiles/snowCenter.png",
+                "SF": "assets/tiles/snow_float.png",
+                "SP": "assets/tiles/special.png",
+                "GL": "assets/tiles/grassLeft.png",
+                "GMT": "assets/tiles/grassMid_top.png",
+                "GR": "assets/tiles/grassRight.png",
+                "GCR": "assets/tiles/grassCliff_right.png",
+                "GCL": "assets/tiles/grassCliff_left.png",
+                "GT": "assets/tiles/grass_top.png",
+                "GC": "assets/tiles/grassCenter.png",
+                "GF": "assets/tiles/grass_float.png",
+                "ML": "assets/tiles/metalLeft.png",
+                "MMT": "assets/tiles/metalMid_top.png",
+                "MR": "assets/tiles/metalRight.png",
+                "MCR": "assets/tiles/metalCliff_right.png",
+                "MCL": "assets/tiles/metalCliff_left.png",
+                "MT": "assets/tiles/metal_top.png",
+                "MC": "assets/tiles/metalCenter.png",
+                "MF": "assets/tiles/metal_float.png",
+                "PCL": "assets/tiles/planetCliff_left.png",
+                "PCR": "assets/tiles/planetCliff_right.png",
+                "PMT": "assets/tiles/planetMid.png",
+                "PC": "assets/tiles/planetCenter.png"}
+
+coin_img = "assets/coins/coinGold.png"
+gem_img = "assets/coins/gemBlue.png"
+heart_img = "assets/items/hudHeart_full.png"
+oneup_img = "assets/items/hudPlayer_beige.png"
+reducedspeed_img = "assets/items/hudPlayer_blue.png"
+exit_img = "assets/items/signExit.png"
+lives_img = "assets/items/life.png"
+star_img = "assets/items/star.png"
+
+slimeBlock_images = ["assets/enemies/slimeBlock.png", "assets/enemies/slimeBlock_move.png"]
+snail_images = ["assets/enemies/snail.png", "assets/enemies/snail_move.png"]
+bee_images = ["assets/enemies/bee.png", "assets/enemies/bee_move.png"]
+
+# Sounds (decoded when a game starts, not at import)
+JUMP_SOUND = "assets/sounds/jump.wav"
+COIN_SOUND = "assets/sounds/pickup_coin.wav"
+POWERUP_SOUND = "assets/sounds/powerup.wav"
+HURT_SOUND = "assets/sounds/hurt.ogg"
+DIE_SOUND = "assets/sounds/death.wav"
+LEVELUP_SOUND = "assets/sounds/level_up.wav"
+GAMEOVER_SOUND = "assets/sounds/game_over.wav"
+
+game_sounds = [JUMP_SOUND, COIN_SOUND, POWERUP_SOUND, HURT_SOUND,
+               DIE_SOUND, LEVELUP_SOUND, GAMEOVER_SOUND]
+
+# Copies of a sound that may play at once (one unless listed), and the channels all of them share
+SOUND_VOICES = {COIN_SOUND: 3}
+SOUND_CHANNELS = 8
+
+class AudioManager():
+
+    # Sound effects share a fixed pool of mixer channels. A sound already playing as many times as it may cuts off
+    # its oldest copy, and a sound triggered again in the same frame only plays once. Music is opened on a worker
+    # thread, and if it is asked to play before that is done it starts as soon as it can.
+    def __init__(self, channels, voices):
+        self.channels = channels
+        self.voices = voices
+        self.playing = {}
+        self.triggered = set()
+
+        self.music_loader = None
+        self.music_error = None
+        self.music_wanted = False
+
+    def init(self):
+        if pygame.mixer.get_init():
+            pygame.mixer.set_num_channels(self.channels)
+
+    def play(self, file_path, loops=0, maxtime=0, fade_ms=0):
+        if not sound_on or not pygame.mixer.get_init() or file_path in self.triggered:
+            return
+
+        self.triggered.add(file_path)
+        sound = load_sound(file_path)
+
+        # Channels that finished or were taken over by another sound have dropped it
+        voices = [channel for channel in self.playing.get(file_path, []) if channel.get_sound() is sound]
+
+        if len(voices) >= self.voices.get(file_path, 1):
+            voices.pop(0).stop()
+
+        channel = sound.play(loops, maxtime, fade_ms)
+
+        if channel is not None:
+            voices.append(channel)
+
+        self.playing[file_path] = voices
+
+    def load_music(self, source):
+        self.wait_for_music()
+        self.music_error = None
+        self.music_wanted = False
+        self.music_loader = threading.Thread(target=self.open_music, args=(source,), daemon=True)
+        self.music_loader.start()
+
+    def open_music(self, source):
+        try:
+            pygame.mixer.music.load(source)
+        except pygame.error as e:
+            # Raised on the main thread once the music is wanted
+            self.music_error = e
+
+    def music_loading(self):
+        return self.music_loader is not None and self.music_loader.is_alive()
+
+    def wait_for_music(self):
+        if self.music_loader is not None:
+            self.music_loader.join()
+
+    def play_music(self):
+        if not sound_on:
+            return
+
+        if self.music_loading():
+            self.music_wanted = True
+        elif self.music_error is not None:
+            error, self.music_error = self.music_error, None
+            raise error
+        else:
+            pygame.mixer.music.play(-1)
+
+    def stop_music(self):
+        # The track being opened isn't playing yet, and the mixer can't be touched until it is open
+        self.music_wanted = False
+
+        if not self.music_loading():
+            pygame.mixer.music.stop()
+
+    def end_frame(self):
+        self.triggered.clear()
+
+        if self.music_wanted and not self.music_loading():
+            self.music_wanted = False
+            self.play_music()
+
+audio = AudioManager(SOUND_CHANNELS, SOUND_VOICES)
+
+# Profiling
+PROFILE_PHASES = ["events", "hero.enemies", "hero.collision", "hero.pickups",
+                  "enemies", "draw.layers", "draw.hud", "flip", "frame"]
+
+class FrameProfiler():
+
+    def __init__(self, phases, history=3600):
+        self.enabled = False
+        self.phases = phases
+        self.history = collections.deque(maxlen=history)
+        self.totals = dict.fromkeys(phases, 0)
+        self.starts = {}
+
+        self.overlay = None
+        self.overlay_age = 0
+
+    def start(self, phase):
+        if self.enabled:
+            self.starts[phase] = time.perf_counter()
+
+    def stop(self, phase):
+        if self.enabled:
+            self.totals[phase] += time.perf_counter() - self.starts[phase]
+
+    def end_frame(self):
+        if self.enabled:
+            self.history.append([self.totals[phase] * 1000 for phase in self.phases])
+            self.totals = dict.fromkeys(self.phases, 0)
+
+    def percentiles(self):
+        stats = {}
+
+        for i, phase in enumerate(self.phases):
+            times = sorted(frame[i] for frame in self.history)
+
+            if len(times) > 0:
+                stats[phase] = {"p%d" % p: times[min(len(times) - 1, int(len(times) * p / 100))] for p in [50, 95, 99]}
+                stats[phase]["max"] = times[-1]
+
+        return stats
+
+    def export(self, file_path):
+        with open(file_path, 'w', newline='') as f:
+            if file_path.endswith(".csv"):
+                writer = csv.writer(f)
+                writer.writerow(["frame"] + [phase + " (ms)" for phase in self.phases])
+
+                for n, frame in enumerate(self.history):
+                    writer.writerow([n] + ["%.4f" % t for t in frame])
+            else:
+                json.dump({"frames": len(self.history), "ms": self.percentiles()}, f, indent=2)
+
+    def draw_overlay(self, surface):
+        # Re-rendered twice a second, the numbers are unreadable at 60 Hz anyway
+        if self.overlay is None or self.overlay_age >= FPS // 2:
+            font = load_font(FONT_XS)
+            rows = [["ms", "p50", "p95", "p99"]]
+
+            for phase, stats in self.percentiles().items():
+                rows.append([phase] + ["%.2f" % stats[p] for p in ["p50", "p95", "p99"]])
+
+            self.overlay = pygame.Surface([280, 22 * len(rows) + 8], pygame.SRCALPHA, 32)
+            self.overlay.fill((0, 0, 0, 160))
+
+            for y, row in enumerate(rows):
+                for x, word in enumerate(row):
+                    text = font.render(word, 1, WHITE)
+                    self.overlay.blit(text, (8 + (100 + 55 * (x - 1) if x > 0 else 0), 4 + 22 * y))
+
+            self.overlay_age = 0
+
+        self.overlay_age += 1
+        surface.blit(self.overlay, (WIDTH - self.overlay.get_width() - 16, HEIGHT - self.overlay.get_height() - 16))
+
+profiler = FrameProfiler(PROFILE_PHASES)
 
 class Entity(pygame.sprite.Sprite):
 
@@ -146,21 +378,550 @@ class Entity(pygame.sprite.Sprite):
         self.vy += level.gravity
         self.vy = min(self.vy, level.terminal_velocity)
 
-class Block(Entity):
+class Block():
+
+    # Tiles never move, so they are plain records in the tile grid rather than sprites
+    __slots__ = ['image', 'rect']
+
+    def __init__(self, x, y, image):
+        self.image = image
+        self.rect = image.get_rect(x=x, y=y)
+
+class Pickup():
+
+    # Pickups sit still until they are collected, so they are plain records too
+    __slots__ = ['image', 'rect']
 
     def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+        self.image = image
+        self.rect = image.get_rect(x=x, y=y)
+
+class PickupGroup():
+
+    # An ordered set of pickups, standing in for the sprite group they used to be in. They are also filed
+    # in a grid shared by all of a level's pickup groups, so a hit test only looks at the hero's cells.
+    def __init__(self, grid):
+        self.grid = grid
+        self.pickups = {}
+
+    def __iter__(self):
+        return iter(self.pickups)
+
+    def __len__(self):
+        return len(self.pickups)
+
+    def __contains__(self, pickup):
+        return pickup in self.pickups
+
+    def add(self, pickups):
+        for pickup in pickups:
+            if pickup not in self.pickups:
+                self.pickups[pickup] = None
+                self.grid.add(pickup)
+
+    def remove(self, pickup):
+        if pickup in self.pickups:
+            del self.pickups[pickup]
+            self.grid.remove(pickup)
+
+    def empty(self):
+        for pickup in self.pickups:
+            self.grid.remove(pickup)
+
+        self.pickups.clear()
+
+    def collide(self, rect, collect=False):
+        if len(self.pickups) == 0:
+            return []
+
+        # The grid numbers pickups as they are added, so hits come back in group order like spritecollide
+        hits = [pickup for pickup in self.grid.collide(rect) if pickup in self.pickups]
+
+        if collect:
+            for pickup in hits:
+                self.remove(pickup)
+
+        return hits
+
+class TileGrid():
+
+    # Shared by every grid, so a version number is never reused even when a grid is replaced by a new one
+    changes = itertools.count(1)
+
+    def __init__(self):
+        self.cells = {}
+        self.count = 0
+        self.version = next(TileGrid.changes)
+
+    def cells_for(self, rect):
+        cols = range(rect.left // GRID_SIZE, (rect.right - 1) // GRID_SIZE + 1)
+        rows = range(rect.top // GRID_SIZE, (rect.bottom - 1) // GRID_SIZE + 1)
+
+        return [(col, row) for col in cols for row in rows]
+
+    def add(self, block, order=None):
+        # Entries remember the order they were added in, so hits come back in the same order spritecollide used
+        if order is None:
+            order = self.count
+            self.count += 1
+
+        self.version = next(TileGrid.changes)
+
+        for cell in self.cells_for(block.rect):
+            self.cells.setdefault(cell, []).append((order, block))
+
+    def remove(self, block):
+        self.version = next(TileGrid.changes)
+
+        for cell in self.cells_for(block.rect):
+            entries = [entry for entry in self.cells[cell] if entry[1] is not block]
+
+            if len(entries) > 0:
+                self.cells[cell] = entries
+            else:
+                del self.cells[cell]
+
+    def collide(self, rect):
+        hits = {}
+
+        for cell in self.cells_for(rect):
+            for n, block in self.cells.get(cell, ()):
+                if rect.colliderect(block.rect):
+                    hits[n] = block
+
+        return [hits[n] for n in sorted(hits)]
+
+    def fills_cells(self):
+        # True when every entry fills exactly one cell on its own, like the level files make them
+        for (col, row), entries in self.cells.items():
+            if len(entries) != 1 or entries[0][1].rect != (col * GRID_SIZE, row * GRID_SIZE, GRID_SIZE, GRID_SIZE):
+                return False
+
+        return True
+
+class BlockShape():
+
+    # A rectangle of solid tiles, standing in for all of them
+    __slots__ = ['rect']
+
+    def __init__(self, rect):
+        self.rect = rect
+
+class BlockShapes():
+
+    # The tiles of a grid merged greedily into large rectangles: runs along each row, then runs with the same ends
+    # in the rows below. Each column keeps the shapes crossing it, so most lookups check one or two shapes.
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.version = None
+        self.columns = None
+
+    def build(self):
+        self.version = self.tiles.version
+        self.columns = None
+
+        if not self.tiles.fills_cells():
+            return
+
+        rows = {}
+
+        for col, row in self.tiles.cells:
+            rows.setdefault(row, []).append(col)
+
+        self.columns = {}
+        above = {}
+
+        for row in sorted(rows):
+            spans = {}
+
+            for key, run in itertools.groupby(enumerate(sorted(rows[row])), lambda item: item[1] - item[0]):
+                cols = [col for n, col in run]
+                span = (cols[0], cols[-1] + 1)
+                shape = above.get(span)
+
+                if shape is not None and shape.rect.bottom == row * GRID_SIZE:
+                    shape.rect.height += GRID_SIZE
+                else:
+                    shape = BlockShape(pygame.Rect(span[0] * GRID_SIZE, row * GRID_SIZE, len(cols) * GRID_SIZE, GRID_SIZE))
+
+                    for col in cols:
+                        self.columns.setdefault(col, []).append(shape)
+
+                spans[span] = shape
+
+            above = spans
+
+    def collide(self, rect, landing=False):
+        # Hits are the tiles themselves, in the order TileGrid.collide gives them, unless the caller is landing
+        # (moving down or not at all) on a single row of tiles. Then only the tops count, plus how far along the
+        # row the tiles go, and a shape has the same top and reaches as far as the tiles it is made of.
+        if self.version != self.tiles.version:
+            self.build()
+
+        if self.columns is None:
+            return self.tiles.collide(rect)
+
+        hits = []
+
+        for col in range(rect.left // GRID_SIZE, (rect.right - 1) // GRID_SIZE + 1):
+            for shape in self.columns.get(col, ()):
+                if shape.rect.top < rect.bottom and rect.top < shape.rect.bottom and shape not in hits:
+                    hits.append(shape)
+
+        if len(hits) == 0:
+            return hits
+
+        top = hits[0].rect.top
+
+        if landing and rect.bottom <= top + GRID_SIZE and all(shape.rect.top == top for shape in hits):
+            return hits
+
+        return self.tiles.collide(rect)
+
+class EnemyGroup(pygame.sprite.Group):
+
+    # Enemies are bucketed by x, so a frame only looks at the buckets around the hero
+    BUCKET_SIZE = 8 * GRID_SIZE
+
+    def __init__(self, *sprites, batched=False):
+        self.buckets = {}
+        self.keys = {}
+        self.order = {}
+        self.count = 0
+        self.widest = 0
+
+        if batched:
+            self.batch = EnemyBatch()
+        else:
+            self.batch = None
+
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+
+        # Hits are reported in the order enemies joined the group, like spritecollide does
+        self.order[sprite] = self.count
+        self.count += 1
+        self.widest = max(self.widest, sprite.rect.width)
+        self.place(sprite)
+
+        if self.batch is not None:
+            self.batch.add(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+
+        self.unplace(sprite)
+        del self.order[sprite]
+
+        if self.batch is not None:
+            self.batch.remove(sprite)
+
+    def place(self, sprite):
+        key = sprite.rect.x // EnemyGroup.BUCKET_SIZE
+
+        if self.keys.get(sprite) != key:
+            self.unplace(sprite)
+            self.keys[sprite] = key
+            self.buckets.setdefault(key, set()).add(sprite)
+
+    def unplace(self, sprite):
+        if sprite in self.keys:
+            key = self.keys.pop(sprite)
+            self.buckets[key].discard(sprite)
+
+            if len(self.buckets[key]) == 0:
+                del self.buckets[key]
+
+    def reindex(self):
+        # For when enemies were moved outside of update(), like Level.reset does
+        for sprite in self.sprites():
+            self.place(sprite)
+
+        if self.batch is not None:
+            self.batch.stale.update(self.sprites())
+
+    def between(self, left, right):
+        found = []
+
+        for key in range(left // EnemyGroup.BUCKET_SIZE, right // EnemyGroup.BUCKET_SIZE + 1):
+            found.extend(self.buckets.get(key, ()))
+
+        return found
+
+    def collide(self, rect):
+        hits = [sprite for sprite in self.between(rect.left - self.widest + 1, rect.right - 1) if rect.colliderect(sprite.rect)]
+
+        return sorted(hits, key=self.order.get)
+
+    def update(self, level, hero):
+        # Enemies don't affect each other, so skipping the far ones (which Enemy.update would skip anyway) changes nothing
+        nearby = self.between(hero.rect.x - 2 * WIDTH + 1, hero.rect.x + 2 * WIDTH - 1)
+
+        if self.batch is not None and len(nearby) >= EnemyBatch.MIN_BATCH:
+            self.batch.update(nearby, level, hero)
+        else:
+            for enemy in nearby:
+                enemy.update(level, hero)
+
+            if self.batch is not None:
+                self.batch.stale.update(nearby)
+
+        for enemy in nearby:
+            if enemy in self.spritedict:
+                self.place(enemy)
+
+class EnemyBatch():
+
+    # Enemy state as NumPy columns, one row per enemy, so a crowd moves in a handful of array operations
+    # instead of a few method calls each. The sprites are written back every frame for drawing and hits.
+    SNAIL = 0
+    SLIME = 1
+    BEE = 2
+    OTHER = -1
+
+    COLUMNS = ['kind', 'x', 'y', 'w', 'h', 'vx', 'vy', 'frames', 'index', 'steps', 'facing', 'shown_facing', 'shown_index']
+
+    # Below this many nearby enemies the plain per-sprite update is quicker than the array setup
+    MIN_BATCH = 32
+
+    def __init__(self):
+        self.sprites = []
+        self.rows = {}
+        self.stale = set()
+
+        for name in EnemyBatch.COLUMNS:
+            setattr(self, name, numpy.zeros(16, numpy.float64 if name == 'vy' else numpy.int64))
+
+        self.grid_version = None
+        self.cells = None
+        self.origin = (0, 0)
+
+    def add(self, sprite):
+        row = len(self.sprites)
+
+        if row == len(self.x):
+            for name in EnemyBatch.COLUMNS:
+                column = getattr(self, name)
+                setattr(self, name, numpy.concatenate([column, numpy.zeros_like(column)]))
+
+        self.sprites.append(sprite)
+        self.rows[sprite] = row
+        self.stale.add(sprite)
+
+    def remove(self, sprite):
+        # The last row moves into the gap
+        row = self.rows.pop(sprite)
+        last = self.sprites.pop()
+        self.stale.discard(sprite)
+
+        if last is not sprite:
+            self.sprites[row] = last
+            self.rows[last] = row
+
+            for name in EnemyBatch.COLUMNS:
+                column = getattr(self, name)
+                column[row] = column[len(self.sprites)]
+
+    def load(self, sprite):
+        row = self.rows[sprite]
+        kind = BATCH_KINDS.get(type(sprite), EnemyBatch.OTHER)
+
+        if sprite.image in sprite.images_right:
+            shown_facing, shown_index = 1, sprite.images_right.index(sprite.image)
+        elif sprite.image in sprite.images_left:
+            shown_facing, shown_index = 0, sprite.images_left.index(sprite.image)
+        else:
+            shown_facing, shown_index, kind = 0, 0, EnemyBatch.OTHER
+
+        # Hits are worked out from the (at most 2x2) grid cells an enemy covers
+        if sprite.rect.width > GRID_SIZE or sprite.rect.height > GRID_SIZE:
+            kind = EnemyBatch.OTHER
+
+        values = [kind, sprite.rect.x, sprite.rect.y, sprite.rect.width, sprite.rect.height, sprite.vx, sprite.vy,
+                  len(sprite.current_images), sprite.image_index, sprite.steps,
+                  sprite.current_images is sprite.images_right, shown_facing, shown_index]
+
+        for name, value in zip(EnemyBatch.COLUMNS, values):
+            getattr(self, name)[row] = value
+
+    def map_blocks(self, grid):
+        # A table of block load orders by cell. Only works when every block fills exactly one cell, like the level files make them.
+        if self.grid_version == grid.version:
+            return self.cells is not None
+
+        self.grid_version = grid.version
+        self.cells = None
+
+        if not grid.fills_cells():
+            return False
+
+        # An empty border all the way round stands in for everything outside the blocks
+        cols, rows = zip(*grid.cells) if len(grid.cells) > 0 else ([0], [0])
+        self.origin = (min(cols) - 1, min(rows) - 1)
+        self.cells = numpy.full((max(cols) - min(cols) + 3, max(rows) - min(rows) + 3), -1, numpy.int64)
+
+        for (col, row), entries in grid.cells.items():
+            self.cells[col - self.origin[0], row - self.origin[1]] = entries[0][0]
+
+        return True
+
+    def touching(self, x, y, w, h):
+        # Block orders (-1 for none) in the four cells each rect could cover, with the cells themselves
+        c0 = x // GRID_SIZE
+        c1 = (x + w - 1) // GRID_SIZE
+        r0 = y // GRID_SIZE
+        r1 = (y + h - 1) // GRID_SIZE
+
+        cols = numpy.array([c0, c1, c0, c1])
+        rows = numpy.array([r0, r0, r1, r1])
+
+        i = numpy.clip(cols - self.origin[0], 0, self.cells.shape[0] - 1)
+        j = numpy.clip(rows - self.origin[1], 0, self.cells.shape[1] - 1)
+        orders = self.cells[i, j]
+
+        # A rect inside one column or row covers the same cell twice
+        orders[1, c1 == c0] = -1
+        orders[2, r1 == r0] = -1
+        orders[3, (c1 == c0) | (r1 == r0)] = -1
+
+        return orders, cols, rows
+
+    def update(self, sprites, level, hero):
+        for sprite in self.stale:
+            self.load(sprite)
+
+        self.stale.clear()
+
+        rows = numpy.array([self.rows[sprite] for sprite in sprites], numpy.int64)
+        near = numpy.abs(self.x[rows] - hero.rect.x) < 2 * WIDTH
+        kind = self.kind[rows]
+        batched = near & (kind != EnemyBatch.OTHER)
+
+        if not self.map_blocks(level.block_grid):
+            batched[:] = False
+
+        rows = rows[batched]
+        kind = kind[batched]
+        n = numpy.arange(len(rows))
+
+        x, y, w, h = self.x[rows], self.y[rows], self.w[rows], self.h[rows]
+        vx, vy = self.vx[rows], self.vy[rows]
+        frames, index, steps = self.frames[rows], self.index[rows], self.steps[rows]
+        facing, shown_facing, shown_index = self.facing[rows], self.shown_facing[rows], self.shown_index[rows]
+
+        def reverse(turn):
+            nonlocal vx, facing, shown_facing, shown_index
+            vx = numpy.where(turn, -vx, vx)
+            facing = numpy.where(turn, vx >= 0, facing)
+            shown_facing = numpy.where(turn, facing, shown_facing)
+            shown_index = numpy.where(turn, index, shown_index)
+
+        slime = kind == EnemyBatch.SLIME
+        falls = kind != EnemyBatch.BEE
+
+        # Gravity
+        vy = numpy.where(falls, numpy.minimum(vy + level.gravity, level.terminal_velocity), vy)
+
+        # Sideways. Hitting two blocks at once reverses twice, which the sprites still do themselves.
+        x = x + vx
+        orders, cols, _ = self.touching(x, y, w, h)
+        hits = (orders >= 0).sum(axis=0)
+        first = numpy.argmin(numpy.where(orders >= 0, orders, numpy.iinfo(numpy.int64).max), axis=0)
+        block_left = cols[first, n] * GRID_SIZE
+
+        tangled = hits > 1
+        stop_right = (hits == 1) & (vx > 0)
+        stop_left = (hits == 1) & (vx < 0)
+        x = numpy.where(stop_right, block_left - w, numpy.where(stop_left, block_left + GRID_SIZE, x))
+        reverse(stop_right | stop_left)
+
+        # Up and down, rounding the way pygame does when a float lands in a Rect
+        t = y + numpy.where(falls, vy + 1, vy)
+        whole = numpy.trunc(t)
+        y = (whole + numpy.sign(t) * (numpy.abs(t - whole) >= 0.5)).astype(numpy.int64)
+
+        orders, cols, rows_hit = self.touching(x, y, w, h)
+        hit = orders >= 0
+        hits = hit.sum(axis=0)
+        first = numpy.argmin(numpy.where(hit, orders, numpy.iinfo(numpy.int64).max), axis=0)
+        last = numpy.argmax(orders, axis=0)
+        first_top = rows_hit[first, n] * GRID_SIZE
+        last_top = rows_hit[last, n] * GRID_SIZE
+
+        # Snails and bees stop at the first block. Slimes keep landing on each block in turn, so the last one wins.
+        land = (hits > 0) & numpy.where(slime, vy >= 0, vy > 0)
+        bump = (hits > 0) & (vy < 0)
+        tangled |= slime & bump & (hits > 1)
+        y = numpy.where(land, numpy.where(slime, last_top, first_top) - h, numpy.where(bump, first_top + GRID_SIZE, y))
+        vy = numpy.where(land | bump, 0.0, vy)
+
+        # Slimes turn around unless one of the blocks under them continues in the direction they are going
+        left = cols * GRID_SIZE
+        ahead = hit & (((vx > 0) & (x + w <= left + GRID_SIZE)) | ((vx < 0) & (x >= left)))
+        reverse(slime & ~(land & ahead.any(axis=0)))
+
+        # World boundaries
+        under = x < 0
+        over = ~under & (x + w > level.width)
+        x = numpy.where(under, 0, numpy.where(over, level.width - w, x))
+        reverse(under | over)
+
+        # Animation
+        fresh = steps == 0
+        shown_facing = numpy.where(fresh, facing, shown_facing)
+        shown_index = numpy.where(fresh, index, shown_index)
+        index = numpy.where(fresh, (index + 1) % frames, index)
+        steps = (steps + 1) % 20
+
+        done = ~tangled
+        rows = rows[done]
+        x, y, vx, vy, index, steps = x[done], y[done], vx[done], vy[done], index[done], steps[done]
+        facing, shown_facing, shown_index = facing[done], shown_facing[done], shown_index[done]
+
+        # Positions and step counters change every frame, the rest only once in a while
+        changed = ((self.vx[rows] != vx) | (self.vy[rows] != vy) | (self.index[rows] != index) | (self.facing[rows] != facing) |
+                   (self.shown_facing[rows] != shown_facing) | (self.shown_index[rows] != shown_index))
+
+        self.x[rows], self.y[rows], self.vx[rows], self.vy[rows], self.index[rows], self.steps[rows] = x, y, vx, vy, index, steps
+        self.facing[rows], self.shown_facing[rows], self.shown_index[rows] = facing, shown_facing, shown_index
+
+        settled = batched.copy()
+        settled[batched] = done
+        moved = [sprites[i] for i in numpy.flatnonzero(settled).tolist()]
+        others = [sprites[i] for i in numpy.flatnonzero(near & ~settled).tolist()]
+
+        for sprite, left, top, step in zip(moved, x.tolist(), y.tolist(), steps.tolist()):
+            sprite.rect.topleft = (left, top)
+            sprite.steps = step
+
+        columns = [column[changed].tolist() for column in [rows, vx, vy, index, facing, shown_facing, shown_index]]
+
+        for row, speed_x, speed_y, image_index, right, shown_right, shown in zip(*columns):
+            sprite = self.sprites[row]
+            sprite.vx, sprite.vy, sprite.image_index = speed_x, speed_y, image_index
+            sprite.current_images = sprite.images_right if right else sprite.images_left
+            sprite.image = (sprite.images_right if shown_right else sprite.images_left)[shown]
+
+        for i in numpy.flatnonzero(y > 640).tolist():
+            moved[i].kill()
+
+        # Everything the arrays can't do exactly goes through the sprites as usual
+        for sprite in others:
+            sprite.update(level, hero)
+            self.stale.add(sprite)
 
 class Character(Entity):
 
     def __init__(self, images):
-        super().__init__(0, 0, images['idle'])
+        super().__init__(0, 0, load_image(images['idle']))
 
-        self.image_idle = images['idle']
-        self.images_run_right = images['run']
-        self.images_run_left = [pygame.transform.flip(img, 1, 0) for img in self.images_run_right]
-        self.image_jump_right = images['jump']
-        self.image_jump_left = pygame.transform.flip(self.image_jump_right, 1, 0)
+        self.image_idle = load_image(images['idle'])
+        self.images_run_right = [load_image(path) for path in images['run']]
+        self.images_run_left = [load_image(path, flip=True) for path in images['run']]
+        self.image_jump_right = load_image(images['jump'])
+        self.image_jump_left = load_image(images['jump'], flip=True)
 
         self.running_images = self.images_run_right
         self.image_index = 0
@@ -201,10 +962,10 @@ class Character(Entity):
     def stop(self):
         self.vx = 0
 
-    def jump(self, blocks):
+    def jump(self, grid):
         self.rect.y += 1
 
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = grid.collide(self.rect)
 
         if len(hit_list) > 0:
             self.vy = -1 * self.jump_power
@@ -224,9 +985,9 @@ class Character(Entity):
             self.lives -= 1
             level.reset()
 
-    def move_and_process_blocks(self, blocks):
+    def move_and_process_blocks(self, grid):
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = grid.collide(self.rect)
 
         for block in hit_list:
             if self.vx > 0:
@@ -238,7 +999,7 @@ class Character(Entity):
 
         self.on_ground = False
         self.rect.y += self.vy + 1
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = grid.collide(self.rect, landing=self.vy >= 0)
 
         for block in hit_list:
             if self.vy > 0:
@@ -250,7 +1011,7 @@ class Character(Entity):
                 self.vy = 0
 
     def process_coins(self, coins):
-        hit_list = pygame.sprite.spritecollide(self, coins, True)
+        hit_list = coins.collide(self.rect, True)
 
         for coin in hit_list:
             play_sound(COIN_SOUND)
@@ -261,7 +1022,7 @@ class Character(Entity):
                 self.score = 0
 
     def process_gems(self, gems):
-        hit_list = pygame.sprite.spritecollide(self, gems, True)
+        hit_list = gems.collide(self.rect, True)
 
         for gem in hit_list:
             play_sound(COIN_SOUND)
@@ -272,7 +1033,7 @@ class Character(Entity):
                 self.score = 0
 
     def process_enemies(self, enemies):
-        hit_list = pygame.sprite.spritecollide(self, enemies, False)
+        hit_list = enemies.collide(self.rect)
         if self.invincibility == 0:
             for enemy in hit_list:
                 if self.vy > 0:
@@ -287,7 +1048,7 @@ class Character(Entity):
         
 
     def process_powerups(self, powerups):
-        hit_list = pygame.sprite.spritecollide(self, powerups, True)
+        hit_list = powerups.collide(self.rect, True)
 
         for p in hit_list:
             play_sound(POWERUP_SOUND)
@@ -299,7 +1060,7 @@ class Character(Entity):
                 self.score = 0
 
     def check_exit(self, level):
-        hit_list = pygame.sprite.spritecollide(self, level.exit, False)
+        hit_list = level.exit.collide(self.rect)
 
         if len(hit_list) > 0:
             level.completed = True
@@ -344,17 +1105,25 @@ class Character(Entity):
         self.speed_timer = 0
 
     def update(self, level):
+        profiler.start("hero.enemies")
         self.process_enemies(level.enemies)
+        profiler.stop("hero.enemies")
+
+        profiler.start("hero.collision")
         self.apply_gravity(level)
-        self.move_and_process_blocks(level.blocks)
+        self.move_and_process_blocks(level.block_shapes)
         self.check_world_boundaries(level)
+        profiler.stop("hero.collision")
+
         self.set_image()
 
         if self.hearts > 0:
+            profiler.start("hero.pickups")
             self.process_coins(level.coins)
             self.process_gems(level.gems)
             self.process_powerups(level.powerups)
             self.check_exit(level)
+            profiler.stop("hero.pickups")
 
             if self.invincibility > 0:
                 self.invincibility -= 1
@@ -364,24 +1133,22 @@ class Character(Entity):
         else:
             self.die()
 
-class Coin(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+class Coin(Pickup):
+    __slots__ = []
 
-        self.value = 5
+    value = 5
 
-class Gem(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+class Gem(Pickup):
+    __slots__ = []
 
-        self.value = 10 
+    value = 10
 
 class Enemy(Entity):
     def __init__(self, x, y, images):
-        super().__init__(x, y, images[0])
+        super().__init__(x, y, load_image(images[0]))
 
-        self.images_left = images
-        self.images_right = [pygame.transform.flip(img, 1, 0) for img in images]
+        self.images_left = [load_image(path) for path in images]
+        self.images_right = [load_image(path, flip=True) for path in images]
         self.current_images = self.images_left
         self.image_index = 0
         self.steps = 0
@@ -424,7 +1191,7 @@ class Enemy(Entity):
     def update(self, level, hero):
         if self.is_near(hero):
             self.apply_gravity(level)
-            self.move_and_process_blocks(level.blocks)
+            self.move_and_process_blocks(level.block_shapes)
             self.check_world_boundaries(level)
             self.set_images()
 
@@ -452,9 +1219,9 @@ class Snail(Enemy):
 
         self.point_value = 5
 
-    def move_and_process_blocks(self, blocks):
+    def move_and_process_blocks(self, grid):
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = grid.collide(self.rect)
 
         for block in hit_list:
             if self.vx > 0:
@@ -465,7 +1232,7 @@ class Snail(Enemy):
                 self.reverse()
 
         self.rect.y += self.vy + 1
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = grid.collide(self.rect, landing=self.vy >= 0)
 
         for block in hit_list:
             if self.vy > 0:
@@ -489,11 +1256,11 @@ class slimeBlock(Enemy):
 
         self.point_value = 7
 
-    def move_and_process_blocks(self, blocks):
+    def move_and_process_blocks(self, grid):
         reverse = False
 
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = grid.collide(self.rect)
 
         for block in hit_list:
             if self.vx > 0:
@@ -504,7 +1271,7 @@ class slimeBlock(Enemy):
                 self.reverse()
 
         self.rect.y += self.vy + 1
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = grid.collide(self.rect, landing=self.vy >= 0)
 
         reverse = True
 
@@ -540,9 +1307,9 @@ class Bee(Enemy):
 
         self.point_value = 10
 
-    def move_and_process_blocks(self, blocks):
+    def move_and_process_blocks(self, grid):
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = grid.collide(self.rect)
 
         for block in hit_list:
             if self.vx > 0:
@@ -553,7 +1320,7 @@ class Bee(Enemy):
                 self.reverse()
 
         self.rect.y += self.vy 
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = grid.collide(self.rect, landing=self.vy >= 0)
 
         for block in hit_list:
             if self.vy > 0:
@@ -565,20 +1332,18 @@ class Bee(Enemy):
 
     def update(self, level, hero):
         if self.is_near(hero):
-            self.move_and_process_blocks(level.blocks)
+            self.move_and_process_blocks(level.block_shapes)
             self.check_world_boundaries(level)
             self.set_images()
 
-class OneUp(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+class OneUp(Pickup):
+    __slots__ = []
 
     def apply(self, character):
         character.lives += 1
 
-class Heart(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+class Heart(Pickup):
+    __slots__ = []
 
     def apply(self, character):
         character.hearts += 1
@@ -587,382 +1352,1399 @@ class Heart(Entity):
         if character.hearts > character.max_hearts:
             character.hearts = character.max_hearts
 
-class ReducedSpeed(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+class ReducedSpeed(Pickup):
+    __slots__ = []
 
     def apply(self, character):
         character.speed_timer = 1300
 
-class Invincibility(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+class Invincibility(Pickup):
+    __slots__ = []
 
     def apply(self, character):
         character.invincibility = int(10 * FPS)
         
-class Exit(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
-
-class Level():
-
-    def __init__(self, file_path):
-        self.starting_blocks = []
-        self.starting_enemies = []
-        self.starting_coins = []
-        self.starting_gems = []
-        self.starting_powerups = []
-        self.starting_exit = []
+class Exit(Pickup):
+    __slots__ = []
 
-        self.blocks = pygame.sprite.Group()
-        self.enemies = pygame.sprite.Group()
-        self.coins = pygame.sprite.Group()
-        self.gems = pygame.sprite.Group()
-        self.powerups = pygame.sprite.Group()
-        self.exit = pygame.sprite.Group()
+# What the spawn lists in a level file turn into, in the order they are loaded
+ENEMY_TYPES = {'snails': (Snail, snail_images),
+               'slimeBlocks': (slimeBlock, slimeBlock_images),
+               'bees': (Bee, bee_images)}
 
-        self.active_sprites = pygame.sprite.Group()
-        self.inactive_sprites = pygame.sprite.Group()
+# Enemies the batched update knows how to move
+BATCH_KINDS = {Snail: EnemyBatch.SNAIL,
+               slimeBlock: EnemyBatch.SLIME,
+               Bee: EnemyBatch.BEE}
 
-        with open(file_path, 'r') as f:
-            data = f.read()
+PICKUP_TYPES = {'coins': (Coin, coin_img, 'coins'),
+                'gems': (Gem, gem_img, 'gems'),
+                'oneups': (OneUp, oneup_img, 'powerups'),
+                'reducedspeed': (ReducedSpeed, reducedspeed_img, 'powerups'),
+                'stars': (Invincibility, star_img, 'powerups'),
+                'hearts': (Heart, heart_img, 'powerups'),
+                'exit': (Exit, exit_img, 'exit')}
 
-        map_data = json.loads(data)
+# Compiled levels
+LEVEL_MAGIC = b"BGLV"
+LEVEL_VERSION = 2
+LEVEL_EXTENSION = ".blvl"
 
-        self.width = map_data['width'] * GRID_SIZE
-        self.height = map_data['height'] * GRID_SIZE
+SPAWN_KINDS = ['snails', 'slimeBlocks', 'bees', 'coins', 'gems',
+               'oneups', 'reducedspeed', 'stars', 'hearts', 'exit']
 
-        self.start_x = map_data['start'][0] * GRID_SIZE
-        self.start_y = map_data['start'][1] * GRID_SIZE
+# Background and scenery scroll at 1/3 and 1/2 speed, so they only need to cover that much of the level
+LAYER_SPEEDS = {'background': 3, 'scenery': 2}
 
-        for item in map_data['blocks']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            img = block_images[item[2]]
-            self.starting_blocks.append(Block(x, y, img))
+def layer_width(settings, prefix):
+    level_width = settings['width'] * GRID_SIZE
 
-        for item in map_data['snails']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_enemies.append(Snail(x, y, snail_images))
+    return min(level_width, WIDTH + (level_width - WIDTH) // LAYER_SPEEDS[prefix] + 1)
 
-        for item in map_data['slimeBlocks']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_enemies.append(slimeBlock(x, y, slimeBlock_images))
+def load_layer_image(settings, prefix):
+    img = pygame.image.load(settings[prefix + '-img'])
 
-        for item in map_data['bees']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_enemies.append(Bee(x, y, bee_images))
+    if settings[prefix + '-fill-y']:
+        h = img.get_height()
+        w = int(img.get_width() * HEIGHT / h)
+        img = pygame.transform.scale(img, (w, HEIGHT))
 
-        for item in map_data['coins']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_coins.append(Coin(x, y, coin_img))
+    return img
 
-        for item in map_data['gems']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_gems.append(Gem(x, y, gem_img))
+class ParallaxLayer():
 
-        for item in map_data['oneups']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(OneUp(x, y, oneup_img))
+    # Background or scenery, drawn straight from one scaled copy of its image. A repeating image is blitted
+    # as many times as it takes to cover the window, starting from wherever the scroll offset has got to.
+    def __init__(self, settings, prefix):
+        self.speed = LAYER_SPEEDS[prefix]
+        self.width = layer_width(settings, prefix)
+        self.height = settings['height'] * GRID_SIZE
+        self.repeat = settings[prefix + '-repeat-x']
 
-        for item in map_data['reducedspeed']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(ReducedSpeed(x, y, reducedspeed_img))
+        if prefix == 'background' and settings['background-color'] != "":
+            self.color = settings['background-color']
+        else:
+            self.color = None
 
-        for item in map_data['stars']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(Invincibility(x, y, star_img))
+        if settings[prefix + '-img'] != "":
+            self.image = load_layer_image(settings, prefix)
 
-        for item in map_data['hearts']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(Heart(x, y, heart_img))
+            if pygame.display.get_surface() is not None:
+                self.image = self.image.convert_alpha()
+        else:
+            self.image = None
 
-        for item in map_data['exit']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+        if self.image is not None and "bottom" in settings[prefix + '-position'] and "top" not in settings[prefix + '-position']:
+            self.y = self.height - self.image.get_height()
+        else:
+            self.y = 0
 
-            self.starting_exit.append(Exit(x, y, exit_img))
+        # Nothing is drawn outside the layer's own bounds
+        if self.image is not None:
+            self.area = self.image.get_rect().clip([0, -self.y, self.image.get_width(), self.height])
 
-        self.background_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.scenery_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.inactive_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.active_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
+    def draw(self, surface, offset_x, offset_y):
+        # Blits drop the fractional part of a position
+        x = int(offset_x / self.speed)
 
-        if map_data['background-color'] != "":
-            self.background_layer.fill(map_data['background-color'])
+        if self.color is not None:
+            surface.fill(self.color, [x, offset_y, self.width, self.height])
 
-        if map_data['background-img'] != "":
-            background_img = pygame.image.load(map_data['background-img'])
+        if self.image is None:
+            return
 
-            if map_data['background-fill-y']:
-                h = background_img.get_height()
-                w = int(background_img.get_width() * HEIGHT / h)
-                background_img = pygame.transform.scale(background_img, (w, HEIGHT))
+        y = offset_y + self.y + self.area.top
+        w = self.image.get_width()
 
-            if "top" in map_data['background-position']:
-                start_y = 0
-            elif "bottom" in map_data['background-position']:
-                start_y = self.height - background_img.get_height()
+        if self.repeat:
+            lefts = range(max(0, -x) // w * w, min(self.width, surface.get_width() - x), w)
+        else:
+            lefts = [0]
 
-            if map_data['background-repeat-x']:
-                for x in range(0, self.width, background_img.get_width()):
-                    self.background_layer.blit(background_img, [x, start_y])
+        for left in lefts:
+            if left + w <= self.width:
+                surface.blit(self.image, [x + left, y], self.area)
             else:
-                self.background_layer.blit(background_img, [0, start_y])
-
-        if map_data['scenery-img'] != "":
-            scenery_img = pygame.image.load(map_data['scenery-img'])
+                surface.blit(self.image, [x + left, y], [0, self.area.top, self.width - left, self.area.height])
 
-            if map_data['scenery-fill-y']:
-                h = scenery_img.get_height()
-                w = int(scenery_img.get_width() * HEIGHT / h)
-                scenery_img = pygame.transform.scale(scenery_img, (w, HEIGHT))
+def file_stamp(file_path, with_hash=True):
+    stat = os.stat(file_path)
+    stamp = {"path": file_path, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
 
-            if "top" in map_data['scenery-position']:
-                start_y = 0
-            elif "bottom" in map_data['scenery-position']:
-                start_y = self.height - scenery_img.get_height()
+    if with_hash:
+        with open(file_path, 'rb') as f:
+            stamp["sha1"] = hashlib.sha1(f.read()).hexdigest()
 
-            if map_data['scenery-repeat-x']:
-                for x in range(0, self.width, scenery_img.get_width()):
-                    self.scenery_layer.blit(scenery_img, [x, start_y])
-            else:
-                self.scenery_layer.blit(scenery_img, [0, start_y])
-
-        pygame.mixer.music.load(map_data['music'])
-
-        self.gravity = map_data['gravity']
-        self.terminal_velocity = map_data['terminal-velocity']
+    return stamp
 
-        self.completed = False
+def is_fresh(stamp):
+    try:
+        current = file_stamp(stamp["path"], with_hash=False)
 
-        self.blocks.add(self.starting_blocks)
-        self.enemies.add(self.starting_enemies)
-        self.coins.add(self.starting_coins)
-        self.gems.add(self.starting_gems)
-        self.powerups.add(self.starting_powerups)
-        self.exit.add(self.starting_exit)
+        if current["mtime_ns"] == stamp["mtime_ns"] and current["size"] == stamp["size"]:
+            return True
 
-        self.active_sprites.add(self.coins, self.gems, self.enemies, self.powerups)
-        self.inactive_sprites.add(self.blocks, self.exit)
+        # Touched but not necessarily changed (a fresh checkout, for example)
+        return file_stamp(stamp["path"])["sha1"] == stamp["sha1"]
+    except OSError:
+        return False
 
-        self.inactive_sprites.draw(self.inactive_layer)
+def compiled_path(file_path):
+    return os.path.splitext(file_path)[0] + LEVEL_EXTENSION
 
-    def reset(self):
-        self.enemies.add(self.starting_enemies)
-        self.coins.add(self.starting_coins)
-        self.gems.add(self.starting_gems)
-        self.powerups.add(self.starting_powerups)
+def compile_level(file_path):
+    # Layout: magic, version, header length, JSON header, then packed int32 arrays
+    with open(file_path, 'r') as f:
+        map_data = json.loads(f.read())
 
-        self.active_sprites.add(self.coins, self.gems, self.enemies, self.powerups)
+    settings = {key: value for key, value in map_data.items() if key not in SPAWN_KINDS and key != 'blocks'}
+    tiles = sorted(set(item[2] for item in map_data['blocks']))
+    tile_ids = {name: n for n, name in enumerate(tiles)}
 
-        for e in self.enemies:
-            e.reset()
+    sections = [("blocks", array.array('i', [v for item in map_data['blocks'] for v in (item[0], item[1], tile_ids[item[2]])]))]
 
-class Game():
+    for kind in SPAWN_KINDS:
+        sections.append((kind, array.array('i', [v for item in map_data[kind] for v in (item[0], item[1])])))
 
-    SPLASH = 0
-    START = 1
-    PLAYING = 2
-    PAUSED = 3
-    LEVEL_COMPLETED = 4
-    GAME_OVER = 5
-    VICTORY = 6
+    offsets = {}
+    offset = 0
 
-    def __init__(self):
-        self.window = pygame.display.set_mode([WIDTH, HEIGHT])
-        pygame.display.set_caption(TITLE)
-        self.clock = pygame.time.Clock()
-        self.done = False
+    for name, data in sections:
+        offsets[name] = [offset, len(data) * getattr(data, 'itemsize', 1)]
+        offset += offsets[name][1]
 
-        self.reset()
+    header = {"sources": [file_stamp(file_path)],
+              "settings": settings,
+              "tiles": tiles,
+              "sections": offsets}
+    header = json.dumps(header).encode()
+    header += b" " * (-(len(header) + 10) % 8)
 
-    def start(self):
-        self.level = Level(levels[self.current_level])
-        self.level.reset()
-        self.hero.respawn(self.level)
+    cache_path = compiled_path(file_path)
 
-    def advance(self):
-        self.current_level += 1
-        self.start()
-        self.stage = Game.START
+    # A temporary file of its own, as parallel workers may all be compiling the same level
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cache_path) or os.curdir)
 
-    def reset(self):
-        self.hero = Character(hero_images)
-        self.current_level = 0
-        self.start()
-        self.stage = Game.SPLASH
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(struct.pack("<4sHI", LEVEL_MAGIC, LEVEL_VERSION, len(header)))
+            f.write(header)
 
-    def display_splash(self, surface):
-        line1 = FONT_LG.render(TITLE, 1, DARK_BLUE)
-        line2 = FONT_SM.render("Press any key to start.", 1, BLACK)
-        img = pygame.image.load("assets/backgrounds/blue_land_splash.png")
-        beige_guy = pygame.image.load("assets/character/alienBiege_front_splash.png")
+            for name, data in sections:
+                f.write(data)
 
-        x1 = WIDTH / 2 - line1.get_width() / 2;
-        y1 = HEIGHT / 3 - line1.get_height() / 2;
+        os.replace(temp_path, cache_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
 
-        x2 = WIDTH / 2 - line2.get_width() / 2;
-        y2 = y1 + line1.get_height() + 16;
+    return map_data
 
-        surface.blit(img, (0, 0))
-        surface.blit(beige_guy, (493,432))
-        surface.blit(line1, (x1, y1))
-        surface.blit(line2, (x2, y2))
+def read_compiled_level(cache_path):
+    with open(cache_path, 'rb') as f:
+        magic, version, header_len = struct.unpack("<4sHI", f.read(10))
 
-    def display_message(self, surface, primary_text, secondary_text):
-        line1 = FONT_MD.render(primary_text, 1, WHITE)
-        line2 = FONT_SM.render(secondary_text, 1, WHITE)
+        if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+            return None
 
-        x1 = WIDTH / 2 - line1.get_width() / 2;
-        y1 = HEIGHT / 3 - line1.get_height() / 2;
+        header = json.loads(f.read(header_len))
 
-        x2 = WIDTH / 2 - line2.get_width() / 2;
-        y2 = y1 + line1.get_height() + 16;
+        if not all(is_fresh(stamp) for stamp in header["sources"]):
+            return None
 
-        #pygame.draw.rect(surface, BLACK, [150, 150, 770, 200])
-        surface.blit(line1, (x1, y1))
-        surface.blit(line2, (x2, y2))
+        start = 10 + header_len
+        map_data = dict(header["settings"])
+        tiles = header["tiles"]
+        sections = header["sections"]
 
-    def display_stats(self, surface):
-        hearts_text = FONT_SM.render("Hearts: " + str(self.hero.hearts) + "/" + str(self.hero.max_hearts), 1, WHITE)
-        lives_text = FONT_SM.render("x " + str(self.hero.lives), 1, WHITE)
-        score_text = FONT_SM.render("Score: " + str(self.hero.score), 1, WHITE)
-        level_text = FONT_SM.render("World " + str(self.current_level + 1), 1, WHITE)
-        pause_text = FONT_SM.render("Paused", 1, WHITE)
+        # A truncated or overwritten cache must not load as a level with pieces missing
+        size = sum(length for offset, length in sections.values())
 
-        surface.blit(lives_img, (32, 96))
-        surface.blit(score_text, (WIDTH - score_text.get_width() - 32, 32))
-        surface.blit(hearts_text, (32, 64))
-        surface.blit(lives_text, (78, 98))
-        surface.blit(level_text, (32, 32))
+        if os.fstat(f.fileno()).st_size != start + size:
+            return None
 
-        if self.stage == Game.PAUSED:
-            surface.blit(pause_text, (WIDTH - score_text.get_width() - 32, 64))
+        # Blocks are (x, y, tile id) and everything else (x, y), all int32
+        for name, (offset, length) in sections.items():
+            if length % (12 if name == 'blocks' else 8) != 0 or offset < 0 or offset + length > size:
+                return None
 
-        if self.stage == Game.VICTORY or self.stage == Game.GAME_OVER:
-            credits_text = FONT_MD.render("Credits", 1, WHITE)
-            credits_text_2 = FONT_SM.render("Art: Kenney", 1, WHITE)
-            credits_text_3 = FONT_SM.render("Sounds & Music: Open Game Art", 1, WHITE)
-            credits_text_4 = FONT_SM.render("Game Template: Jon Cooper", 1, WHITE)
-            credits_text_5 = FONT_SM.render("Everything Else: Colby Brown", 1, WHITE)
+        tile_ids = range(len(tiles))
 
-            
-            pygame.draw.rect(surface, BLACK, [0, 0, 1088, 640])
-            surface.blit(credits_text, (460, 300))
-            surface.blit(credits_text_2, (420, 370))
-            surface.blit(credits_text_3, (420, 400))
-            surface.blit(credits_text_4, (420, 430))
-            surface.blit(credits_text_5, (420, 460))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for name, (offset, length) in sections.items():
+                    with view[start + offset:start + offset + length] as section, section.cast('i') as v:
+                        if name == 'blocks':
+                            if not all(v[i] in tile_ids for i in range(2, len(v), 3)):
+                                return None
 
-    def process_events(self):
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                self.done = True
+                            map_data[name] = [(v[i], v[i + 1], tiles[v[i + 2]]) for i in range(0, len(v), 3)]
+                        else:
+                            map_data[name] = [(v[i], v[i + 1]) for i in range(0, len(v), 2)]
 
-            elif event.type == pygame.KEYDOWN:
-                if self.stage == Game.SPLASH or self.stage == Game.START:
-                    self.stage = Game.PLAYING
-                    play_music()
+    return map_data
 
-                elif self.stage == Game.PLAYING:
-                    if event.key == JUMP or event.key == JUMP_2:
-                        self.hero.jump(self.level.blocks)
-                    if event.key == PAUSE:
-                        self.stage = Game.PAUSED
+def load_level_data(file_path):
+    try:
+        compiled = read_compiled_level(compiled_path(file_path))
 
-                elif self.stage == Game.PAUSED:
-                    if event.key == PAUSE:
-                        self.stage = Game.PLAYING
+        if compiled is not None:
+            return compiled
+    except (OSError, ValueError, KeyError, TypeError, IndexError, struct.error):
+        pass
 
-                elif self.stage == Game.LEVEL_COMPLETED:
-                    self.advance()
+    try:
+        return compile_level(file_path)
+    except OSError:
+        # Read-only install, so play straight from the JSON
+        with open(file_path, 'r') as f:
+            return json.loads(f.read())
 
-                elif self.stage == Game.VICTORY or self.stage == Game.GAME_OVER:
-                    if event.key == pygame.K_r:
-                        self.reset()
+class Level():
 
-        pressed = pygame.key.get_pressed()
+    def __init__(self, file_path, streaming=False):
+        self.starting_blocks = []
+        self.starting_enemies = []
+        self.starting_coins = []
+        self.starting_gems = []
+        self.starting_powerups = []
+        self.starting_exit = []
+
+        self.block_grid = TileGrid()
+        self.block_shapes = BlockShapes(self.block_grid)
+        self.enemies = EnemyGroup(batched=batch_enemies)
+        self.pickup_grid = TileGrid()
+        self.coins = PickupGroup(self.pickup_grid)
+        self.gems = PickupGroup(self.pickup_grid)
+        self.powerups = PickupGroup(self.pickup_grid)
+        self.exit = PickupGroup(self.pickup_grid)
+
+        map_data = load_level_data(file_path)
+
+        self.width = map_data['width'] * GRID_SIZE
+        self.height = map_data['height'] * GRID_SIZE
+
+        self.start_x = map_data['start'][0] * GRID_SIZE
+        self.start_y = map_data['start'][1] * GRID_SIZE
+
+        if streaming:
+            # Nothing is built up front, the streamer creates it chunk by chunk around the camera
+            spawns = map_data
+            map_data = dict(map_data, **{kind: [] for kind in SPAWN_KINDS + ['blocks']})
+
+        for item in map_data['blocks']:
+            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+            img = load_image(block_images[item[2]])
+            block = Block(x, y, img)
+            self.starting_blocks.append(block)
+            self.block_grid.add(block)
+
+        starting = {'coins': self.starting_coins,
+                    'gems': self.starting_gems,
+                    'powerups': self.starting_powerups,
+                    'exit': self.starting_exit}
+
+        for kind, (cls, images) in ENEMY_TYPES.items():
+            for item in map_data[kind]:
+                x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+                self.starting_enemies.append(cls(x, y, images))
+
+        for kind, (cls, img, group) in PICKUP_TYPES.items():
+            for item in map_data[kind]:
+                x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+                starting[group].append(cls(x, y, load_image(img)))
+
+        # Only the renderer needs the background and scenery, so their images are loaded later by load_layers
+        self.layer_settings = {key: value for key, value in map_data.items()
+                               if key.startswith("background") or key.startswith("scenery") or key in ['width', 'height']}
+        self.layers = None
+
+        self.music = map_data['music']
+
+        self.gravity = map_data['gravity']
+        self.terminal_velocity = map_data['terminal-velocity']
+
+        self.completed = False
+
+        self.enemies.add(self.starting_enemies)
+        self.coins.add(self.starting_coins)
+        self.gems.add(self.starting_gems)
+        self.powerups.add(self.starting_powerups)
+        self.exit.add(self.starting_exit)
+
+        # Tiles and the exit never change, so the viewport draws them by column
+        self.inactive_columns = {}
+
+        for sprite in self.starting_blocks + self.starting_exit:
+            col = sprite.rect.x // GRID_SIZE
+            self.inactive_columns.setdefault(col, []).append(sprite)
+
+        if streaming:
+            self.streamer = LevelStreamer(self, spawns)
+        else:
+            self.streamer = None
+
+    def load_layers(self):
+        if self.layers is None:
+            self.layers = [ParallaxLayer(self.layer_settings, prefix) for prefix in LAYER_SPEEDS]
+
+    def reset(self):
+        self.enemies.add(self.starting_enemies)
+        self.coins.add(self.starting_coins)
+        self.gems.add(self.starting_gems)
+        self.powerups.add(self.starting_powerups)
+
+        for e in self.enemies:
+            e.reset()
+
+        self.enemies.reindex()
+
+        if self.streamer is not None:
+            self.streamer.reset()
+
+    def stream(self, camera_x):
+        if self.streamer is not None:
+            self.streamer.update(camera_x)
+
+    def draw_layers(self, surface, offset_x, offset_y):
+        self.load_layers()
+
+        for layer in self.layers:
+            layer.draw(surface, offset_x, offset_y)
+
+    def restore(self):
+        # Back to how it was loaded, with the groups refilled in the original order
+        self.completed = False
+
+        for group in [self.enemies, self.coins, self.gems, self.powerups]:
+            group.empty()
+
+        for e in self.starting_enemies:
+            e.current_images = e.images_left
+            e.image_index = 0
+
+        if self.streamer is not None:
+            self.streamer.ranks = None
+
+        self.reset()
+
+class LevelStreamer():
+
+    # Chunks within this distance of the view are live: every enemy that can move (near the hero) and the blocks
+    # it can touch. They are evicted once a further chunk beyond that, so crossing a boundary doesn't thrash.
+    MARGIN = 2 * WIDTH + 4 * GRID_SIZE
+
+    def __init__(self, level, map_data, chunk_columns=16):
+        self.level = level
+        self.chunk_width = chunk_columns * GRID_SIZE
+        self.chunk_count = (level.width - 1) // self.chunk_width + 1
+
+        # Spawns are kept as plain tuples per chunk, only the live chunks have sprites
+        self.blocks = [[] for i in range(self.chunk_count)]
+        self.starting_pickups = [[] for i in range(self.chunk_count)]
+        self.starting_enemies = [[] for i in range(self.chunk_count)]
+
+        for n, item in enumerate(map_data['blocks']):
+            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+            self.blocks[self.chunk_of(x)].append((n, x, y, item[2]))
+
+        # The group order decides who gets stomped when the hero lands on two enemies at once, so it has to
+        # match a resident level: load order at first, then after each reset the survivors followed by the rest
+        order = 0
+
+        for kind in ENEMY_TYPES:
+            for item in map_data[kind]:
+                x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+                self.starting_enemies[self.chunk_of(x)].append((kind, order, x, y, None))
+                order += 1
+
+        self.enemy_count = order
+        self.ranks = None
+
+        for kind in PICKUP_TYPES:
+            for item in map_data[kind]:
+                x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+                self.starting_pickups[self.chunk_of(x)].append((kind, x, y))
+
+        self.reset()
+
+    def chunk_of(self, x):
+        return min(max(int(x) // self.chunk_width, 0), self.chunk_count - 1)
+
+    def chunks_near(self, camera_x, margin):
+        return range(self.chunk_of(camera_x - margin), self.chunk_of(camera_x + WIDTH + margin) + 1)
+
+    def reset(self):
+        level = self.level
+
+        if self.ranks is None:
+            self.ranks = list(range(self.enemy_count))
+        else:
+            alive = set(enemy.order for enemy in level.enemies)
+            alive.update(record[1] for chunk in self.enemies for record in chunk)
+            survivors = sorted(alive, key=lambda order: self.ranks[order])
+            killed = [order for order in range(self.enemy_count) if order not in alive]
+
+            for rank, order in enumerate(survivors + killed):
+                self.ranks[order] = rank
+
+        for group in [level.enemies, level.coins, level.gems, level.powerups, level.exit]:
+            group.empty()
+
+        level.block_grid = TileGrid()
+        level.block_shapes = BlockShapes(level.block_grid)
+        level.inactive_columns = {}
+
+        self.pickups = [list(chunk) for chunk in self.starting_pickups]
+        self.enemies = [list(chunk) for chunk in self.starting_enemies]
+        self.live = {}
+        self.wanted = None
+
+        # Where the camera will be once the hero respawns
+        self.update(min(max(level.start_x + GRID_SIZE / 2 - WIDTH / 2, 0), level.width - WIDTH))
+
+    def update(self, camera_x):
+        wanted = self.chunks_near(camera_x, LevelStreamer.MARGIN)
+
+        if wanted == self.wanted:
+            return
+
+        self.wanted = wanted
+
+        for i in wanted:
+            if i not in self.live:
+                self.activate(i)
+
+        kept = self.chunks_near(camera_x, LevelStreamer.MARGIN + self.chunk_width)
+        evicted = [i for i in self.live if i not in kept]
+
+        for i in evicted:
+            self.deactivate(i)
+
+        # Enemies belong to the chunk they are in now, not the one they started in
+        if len(evicted) > 0:
+            for enemy in self.level.enemies.sprites():
+                if self.chunk_of(enemy.rect.x) not in self.live:
+                    self.enemies[self.chunk_of(enemy.rect.x)].append(self.save_enemy(enemy))
+                    enemy.kill()
+
+    def activate(self, i):
+        level = self.level
+        blocks = []
+        pickups = []
+
+        for n, x, y, tile in self.blocks[i]:
+            block = Block(x, y, load_image(block_images[tile]))
+            level.block_grid.add(block, n)
+            level.inactive_columns.setdefault(x // GRID_SIZE, []).append(block)
+            blocks.append(block)
+
+        for record in self.pickups[i]:
+            kind, x, y = record
+            cls, img, group = PICKUP_TYPES[kind]
+            sprite = cls(x, y, load_image(img))
+            getattr(level, group).add([sprite])
+
+            if group == 'exit':
+                level.inactive_columns.setdefault(x // GRID_SIZE, []).append(sprite)
+
+            pickups.append((sprite, record))
+
+        for record in self.enemies[i]:
+            level.enemies.add(self.load_enemy(record))
+
+        if len(self.enemies[i]) > 0:
+            enemies = sorted(level.enemies, key=lambda enemy: self.ranks[enemy.order])
+            level.enemies.empty()
+            level.enemies.add(enemies)
+
+        self.enemies[i] = []
+        self.live[i] = (blocks, pickups)
+
+    def deactivate(self, i):
+        blocks, pickups = self.live.pop(i)
+
+        for block in blocks:
+            self.level.block_grid.remove(block)
+
+        for col in range(i * self.chunk_width // GRID_SIZE, (i + 1) * self.chunk_width // GRID_SIZE):
+            self.level.inactive_columns.pop(col, None)
+
+        # Whatever was picked up stays picked up until the level is reset
+        groups = [getattr(self.level, PICKUP_TYPES[record[0]][2]) for sprite, record in pickups]
+        self.pickups[i] = [record for (sprite, record), group in zip(pickups, groups) if sprite in group]
+
+        for (sprite, record), group in zip(pickups, groups):
+            group.remove(sprite)
+
+    def save_enemy(self, enemy):
+        images = enemy.images_left + enemy.images_right
+        state = (enemy.rect.x, enemy.rect.y, enemy.vx, enemy.vy, enemy.current_images is enemy.images_left,
+                 enemy.image_index, enemy.steps, images.index(enemy.image))
+
+        return (enemy.kind, enemy.order, enemy.start_x, enemy.start_y, state)
+
+    def load_enemy(self, record):
+        kind, order, x, y, state = record
+        cls, images = ENEMY_TYPES[kind]
+        enemy = cls(x, y, images)
+        enemy.kind = kind
+        enemy.order = order
+
+        if state is not None:
+            enemy.rect.x, enemy.rect.y, enemy.vx, enemy.vy, facing_left, enemy.image_index, enemy.steps, image = state
+            enemy.current_images = enemy.images_left if facing_left else enemy.images_right
+            enemy.image = (enemy.images_left + enemy.images_right)[image]
+
+        return enemy
+
+class Viewport():
+
+    def __init__(self, level, margin=2):
+        self.level = level
+        self.margin = margin
+        self.columns = WIDTH // GRID_SIZE + 1 + 2 * margin
+
+        self.tile_layer = pygame.Surface([self.columns * GRID_SIZE, HEIGHT], pygame.SRCALPHA, 32)
+        self.first_column = None
+
+    def show(self, level):
+        self.level = level
+        self.first_column = None
+
+    def compose_tiles(self, first_column):
+        self.tile_layer.fill(TRANSPARENT)
+        left = first_column * GRID_SIZE
+
+        # Start one column early so a tile poking in from the left still gets drawn
+        for col in range(first_column - 1, first_column + self.columns):
+            for sprite in self.level.inactive_columns.get(col, []):
+                self.tile_layer.blit(sprite.image, [sprite.rect.x - left, sprite.rect.y])
+
+        self.first_column = first_column
+
+    def draw_tiles(self, surface, offset_x, offset_y):
+        first = int(-offset_x) // GRID_SIZE
+        last = (int(-offset_x) + WIDTH - 1) // GRID_SIZE
+
+        if self.first_column is None or first < self.first_column or last >= self.first_column + self.columns:
+            self.compose_tiles(first - self.margin)
+
+        surface.blit(self.tile_layer, [self.first_column * GRID_SIZE + offset_x, offset_y])
+
+    def sprites(self, hero, offset_x, offset_y):
+        # Everything that moves or can disappear, as (image, position) pairs in drawing order
+        view = pygame.Rect(-offset_x, -offset_y, WIDTH, HEIGHT)
+        visible = []
+
+        # Pickups go underneath the enemies walking over them
+        for sprite in itertools.chain(self.level.coins, self.level.gems, self.level.powerups, self.level.enemies):
+            if view.colliderect(sprite.rect):
+                visible.append((sprite.image, (sprite.rect.x + offset_x, sprite.rect.y + offset_y)))
+
+        if hero.invincibility % 3 < 2:
+            visible.append((hero.image, (hero.rect.x + offset_x, hero.rect.y + offset_y)))
+
+        return visible
+
+class LevelLoader():
+
+    def __init__(self, keep=levels[0], max_size=1, streaming=False):
+        # Built levels are reused, so restarts only reset the dynamic state. The first world is
+        # always kept since every restart goes back to it, plus the max_size most recent others.
+        self.keep = keep
+        self.max_size = max_size
+        self.streaming = streaming
+        self.pool = collections.OrderedDict()
+        self.pending = {}
+
+    def build(self, file_path, result):
+        try:
+            level = Level(file_path, self.streaming)
+            level.load_layers()
+
+            if sound_on:
+                with open(level.music, 'rb') as f:
+                    result['music'] = f.read()
+
+            result['level'] = level
+        except Exception:
+            # get() builds it again on the main thread, where the error can surface normally
+            pass
+
+    def prefetch(self, file_path):
+        # Only the next world is kept ready, so a longer level list doesn't hold more in memory
+        self.pending = {path: job for path, job in self.pending.items() if path == file_path}
+
+        if file_path not in self.pending and file_path not in self.pool:
+            result = {}
+            thread = threading.Thread(target=self.build, args=(file_path, result), daemon=True)
+            thread.start()
+            self.pending[file_path] = (thread, result)
+
+    def load(self, file_path):
+        if file_path in self.pending:
+            thread, result = self.pending.pop(file_path)
+            thread.join()
+
+            if 'level' in result:
+                return result['level'], result.get('music')
+
+        level = Level(file_path, self.streaming)
+        level.load_layers()
+
+        return level, None
+
+    def get(self, file_path):
+        if file_path in self.pool:
+            level, music = self.pool[file_path]
+            level.restore()
+        else:
+            level, music = self.load(file_path)
+
+        self.pool[file_path] = (level, music)
+        self.pool.move_to_end(file_path)
+
+        others = [path for path in self.pool if path != self.keep]
+
+        for path in others[:-self.max_size]:
+            del self.pool[path]
+
+        # Music is played from memory when it was read ahead, a new file object each time since pygame closes it
+        if music is not None:
+            return level, io.BytesIO(music)
+        else:
+            return level, level.music
+
+def camera_offset(hero, level):
+    x = -1 * hero.rect.centerx + WIDTH / 2
+
+    if hero.rect.centerx < WIDTH / 2:
+        x = 0
+    elif hero.rect.centerx > level.width - WIDTH / 2:
+        x = -1 * level.width + WIDTH
+
+    return x, 0
+
+class Simulation():
+
+    def __init__(self, file_path, inputs, streaming=False):
+        self.level = Level(file_path, streaming)
+        self.level.reset()
+
+        self.hero = Character(hero_images)
+        self.hero.respawn(self.level)
+
+        self.inputs = inputs
+        self.paused = False
+        self.frames = 0
+        self.deaths = 0
+        self.elapsed = 0
+        self.outcome = "unfinished"
+
+    def step(self, state):
+        self.frames += 1
+
+        if state & INPUT_PAUSE:
+            self.paused = not self.paused
+
+        if self.paused:
+            return
+
+        if state & INPUT_JUMP:
+            self.hero.jump(self.level.block_shapes)
+
+        if state & INPUT_LEFT:
+            self.hero.move_left()
+        elif state & INPUT_RIGHT:
+            self.hero.move_right()
+        else:
+            self.hero.stop()
+
+        lives = self.hero.lives
+
+        self.level.stream(-camera_offset(self.hero, self.level)[0])
+        self.hero.update(self.level)
+
+        profiler.start("enemies")
+        self.level.enemies.update(self.level, self.hero)
+        profiler.stop("enemies")
+        profiler.end_frame()
+        audio.end_frame()
+
+        self.deaths += max(0, lives - self.hero.lives)
+
+        if self.level.completed:
+            self.outcome = "completed"
+        elif self.hero.lives == 0:
+            self.outcome = "game over"
+        elif self.hero.hearts == 0:
+            self.level.reset()
+            self.hero.respawn(self.level)
+
+    def run(self, max_frames=None):
+        start = time.perf_counter()
+
+        for state in self.inputs:
+            if self.outcome != "unfinished" or self.frames == max_frames:
+                break
+
+            self.step(state)
+
+        self.elapsed = time.perf_counter() - start
+
+        return self.outcome
+
+    def fps(self):
+        if self.elapsed == 0:
+            return 0
+
+        return self.frames / self.elapsed
+
+def read_input_script(file_path):
+    # Each line is "<frames> [LEFT|RIGHT] [JUMP] [PAUSE]". LEFT and RIGHT are held for the
+    # whole run of frames, JUMP and PAUSE are a single key press on its first frame.
+    with open(file_path, 'r') as f:
+        for line in f:
+            words = line.split('#')[0].split()
+
+            if len(words) == 0:
+                continue
+
+            state = 0
+
+            for word in words[1:]:
+                state |= INPUT_NAMES[word.upper()]
+
+            for i in range(int(words[0])):
+                if i == 0:
+                    yield state
+                else:
+                    yield state & (INPUT_LEFT | INPUT_RIGHT)
+
+class InputLog():
+
+    MAGIC = b"BGIN"
+
+    def __init__(self, states=b""):
+        self.states = bytearray(states)
+
+    def append(self, state):
+        self.states.append(state)
+
+    def save(self, file_path):
+        # Stored as (count, state) runs, since inputs are usually held for many frames
+        runs = bytearray()
+        i = 0
+
+        while i < len(self.states):
+            state = self.states[i]
+            count = 1
+
+            while i + count < len(self.states) and self.states[i + count] == state and count < 255:
+                count += 1
+
+            runs += bytes([count, state])
+            i += count
+
+        with open(file_path, 'wb') as f:
+            f.write(InputLog.MAGIC + struct.pack("<I", len(self.states)) + runs)
+
+    @staticmethod
+    def load(file_path):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+
+        if data[:4] != InputLog.MAGIC:
+            raise ValueError(file_path + " is not an input recording")
+
+        log = InputLog()
+
+        for i in range(8, len(data), 2):
+            log.states += bytes([data[i + 1]]) * data[i]
+
+        if len(log.states) != struct.unpack("<I", data[4:8])[0]:
+            raise ValueError(file_path + " is truncated")
+
+        return log
+
+class FramePacer():
+
+    # The simulation always advances in steps of 1/rate seconds, however long drawing takes. A slow draw is
+    # made up for by running several steps before the next one, skipping at most max_skip draws in a row.
+    # Past that the game slows down rather than jumping ahead.
+    def __init__(self, rate, max_skip, uncapped=False):
+        self.step = 1 / rate
+        self.max_skip = max_skip
+        self.uncapped = uncapped
+        self.due = None
+
+    def ticks(self):
+        # Waits until the next step is due and returns how many steps to run before drawing
+        if self.uncapped:
+            return 1
+
+        if self.due is None:
+            self.due = time.perf_counter()
+
+        wait = self.due - time.perf_counter()
+
+        if wait > 0:
+            time.sleep(wait)
+
+        now = time.perf_counter()
+        ticks = min(int((now - self.due) / self.step) + 1, self.max_skip + 1)
+        self.due = max(self.due + ticks * self.step, now)
+
+        return ticks
+
+class TextCache():
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.surfaces = collections.OrderedDict()
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+
+        if key in self.surfaces:
+            self.surfaces.move_to_end(key)
+        else:
+            self.surfaces[key] = load_font(font).render(text, 1, color)
+
+            if len(self.surfaces) > self.max_size:
+                self.surfaces.popitem(last=False)
+
+        return self.surfaces[key]
+
+class HudField():
+
+    def __init__(self, font, template, color=WHITE):
+        self.font = font
+        self.template = template
+        self.color = color
+
+        self.values = None
+        self.surface = None
+
+    def render(self, *values):
+        if values != self.values:
+            self.surface = load_font(self.font).render(self.template.format(*values), 1, self.color)
+            self.values = values
+
+        return self.surface
+
+class Game():
+
+    SPLASH = 0
+    START = 1
+    PLAYING = 2
+    PAUSED = 3
+    LEVEL_COMPLETED = 4
+    GAME_OVER = 5
+    VICTORY = 6
+
+    def __init__(self):
+        pygame.mixer.pre_init()
+        pygame.init()
+        audio.init()
+
+        self.window = pygame.display.set_mode([WIDTH, HEIGHT])
+        pygame.display.set_caption(TITLE)
+        images.convert()
+        self.pacer = FramePacer(FPS, max_frame_skip, uncapped)
+        self.done = False
+        self.startup_time = None
+        self.recording = None
+        self.show_profile = False
+        self.loader = LevelLoader(streaming=stream_levels)
+        self.viewport = None
+        self.last_frame = None
+
+        self.text = TextCache()
+        self.hearts_field = HudField(FONT_SM, "Hearts: {}/{}")
+        self.lives_field = HudField(FONT_SM, "x {}")
+        self.score_field = HudField(FONT_SM, "Score: {}")
+        self.level_field = HudField(FONT_SM, "World {}")
+        self.build_screens()
+
+        self.reset()
+
+    def start(self, file_path=None):
+        if file_path is None:
+            file_path = levels[self.current_level]
+
+        if sound_on:
+            for sound in game_sounds:
+                load_sound(sound)
+
+        self.level, music = self.loader.get(file_path)
+        self.level.reset()
+        self.hero.respawn(self.level)
+
+        if self.viewport is None:
+            self.viewport = Viewport(self.level)
+        else:
+            self.viewport.show(self.level)
+
+        # Level loads don't wait on the music file being opened
+        if sound_on:
+            audio.load_music(music)
+
+        # The next world is built in the background while this one is played
+        if self.current_level + 1 < len(levels):
+            self.loader.prefetch(levels[self.current_level + 1])
+
+    def advance(self):
+        self.current_level += 1
+        self.start()
+        self.stage = Game.START
+
+    def reset(self):
+        self.hero = Character(hero_images)
+        self.current_level = 0
+        self.start()
+        self.stage = Game.SPLASH
+
+    def build_screens(self):
+        # Splash, credits and messages never change, so they are composed once and converted for fast blits
+        self.splash_screen = self.compose_splash()
+        self.credits_screen = self.compose_credits()
+
+        self.start_message = self.compose_message("Ready?!!!", "Press any key to start.")
+        self.completed_message = self.compose_message("Level Complete", "Press any key to continue.")
+        self.victory_message = self.compose_message("You Win!", "Press 'R' to restart.")
+        self.game_over_message = self.compose_message("Game Over", "Press 'R' to restart.")
+
+    def compose_splash(self):
+        line1 = self.text.render(FONT_LG, TITLE, DARK_BLUE)
+        line2 = self.text.render(FONT_SM, "Press any key to start.", BLACK)
+        img = pygame.image.load("assets/backgrounds/blue_land_splash.png")
+        beige_guy = pygame.image.load("assets/character/alienBiege_front_splash.png")
+
+        x1 = WIDTH / 2 - line1.get_width() / 2;
+        y1 = HEIGHT / 3 - line1.get_height() / 2;
+
+        x2 = WIDTH / 2 - line2.get_width() / 2;
+        y2 = y1 + line1.get_height() + 16;
+
+        screen = pygame.Surface(img.get_size(), pygame.SRCALPHA, 32)
+        screen.blit(img, (0, 0))
+        screen.blit(beige_guy, (493,432))
+        screen.blit(line1, (x1, y1))
+        screen.blit(line2, (x2, y2))
+
+        return screen.convert_alpha()
+
+    def compose_credits(self):
+        credits_text = self.text.render(FONT_MD, "Credits", WHITE)
+        credits_text_2 = self.text.render(FONT_SM, "Art: Kenney", WHITE)
+        credits_text_3 = self.text.render(FONT_SM, "Sounds & Music: Open Game Art", WHITE)
+        credits_text_4 = self.text.render(FONT_SM, "Game Template: Jon Cooper", WHITE)
+        credits_text_5 = self.text.render(FONT_SM, "Everything Else: Colby Brown", WHITE)
+
+        screen = pygame.Surface([WIDTH, HEIGHT])
+        screen.fill(BLACK)
+        screen.blit(credits_text, (460, 300))
+        screen.blit(credits_text_2, (420, 370))
+        screen.blit(credits_text_3, (420, 400))
+        screen.blit(credits_text_4, (420, 430))
+        screen.blit(credits_text_5, (420, 460))
+
+        return screen.convert()
+
+    def compose_message(self, primary_text, secondary_text):
+        line1 = self.text.render(FONT_MD, primary_text, WHITE)
+        line2 = self.text.render(FONT_SM, secondary_text, WHITE)
+
+        x1 = WIDTH / 2 - line1.get_width() / 2;
+        y1 = HEIGHT / 3 - line1.get_height() / 2;
+
+        x2 = WIDTH / 2 - line2.get_width() / 2;
+        y2 = y1 + line1.get_height() + 16;
+
+        # Blits drop the fractional part of a position, so do the same before making them relative
+        x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+        left = min(x1, x2)
+        width = max(x1 + line1.get_width(), x2 + line2.get_width()) - left
+        height = y2 + line2.get_height() - y1
+
+        message = pygame.Surface([width, height], pygame.SRCALPHA, 32)
+        message.blit(line1, (x1 - left, 0))
+        message.blit(line2, (x2 - left, y2 - y1))
+
+        return message.convert_alpha(), (left, y1)
+
+    def stats(self):
+        hearts_text = self.hearts_field.render(self.hero.hearts, self.hero.max_hearts)
+        lives_text = self.lives_field.render(self.hero.lives)
+        score_text = self.score_field.render(self.hero.score)
+        level_text = self.level_field.render(self.current_level + 1)
+
+        items = [(load_image(lives_img, 50, 50), (32, 96)),
+                 (score_text, (WIDTH - score_text.get_width() - 32, 32)),
+                 (hearts_text, (32, 64)),
+                 (lives_text, (78, 98)),
+                 (level_text, (32, 32))]
+
+        if self.stage == Game.PAUSED:
+            pause_text = self.text.render(FONT_SM, "Paused", WHITE)
+            items.append((pause_text, (WIDTH - score_text.get_width() - 32, 64)))
+
+        return items
+
+    def hud(self):
+        # The stats and whatever screen or message this stage shows, as (image, position) pairs
+        items = []
+
+        if self.stage != Game.VICTORY and self.stage != Game.GAME_OVER:
+            items += self.stats()
+
+        if self.stage == Game.SPLASH:
+            items.append((self.splash_screen, (0, 0)))
+        elif self.stage == Game.START:
+            items.append(self.start_message)
+        elif self.stage == Game.LEVEL_COMPLETED:
+            items.append(self.completed_message)
+        elif self.stage == Game.VICTORY:
+            items.append(self.victory_message)
+        elif self.stage == Game.GAME_OVER:
+            items.append(self.game_over_message)
+
+        return items
+
+    def read_input(self):
+        state = 0
+
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                state |= INPUT_QUIT
+
+            elif event.type == pygame.KEYDOWN:
+                state |= INPUT_KEY
+
+                if event.key == JUMP or event.key == JUMP_2:
+                    state |= INPUT_JUMP
+                elif event.key == PAUSE:
+                    state |= INPUT_PAUSE
+                elif event.key == pygame.K_r:
+                    state |= INPUT_RESTART
+
+        pressed = pygame.key.get_pressed()
+
+        if pressed[LEFT]:
+            state |= INPUT_LEFT
+        if pressed[RIGHT]:
+            state |= INPUT_RIGHT
+
+        return state
+
+    def apply_input(self, state):
+        if state & INPUT_QUIT:
+            self.done = True
+
+        if state & INPUT_KEY:
+            if self.stage == Game.SPLASH or self.stage == Game.START:
+                self.stage = Game.PLAYING
+                play_music()
+
+            elif self.stage == Game.PLAYING:
+                if state & INPUT_JUMP:
+                    self.hero.jump(self.level.block_shapes)
+                if state & INPUT_PAUSE:
+                    self.stage = Game.PAUSED
+
+            elif self.stage == Game.PAUSED:
+                if state & INPUT_PAUSE:
+                    self.stage = Game.PLAYING
+
+            elif self.stage == Game.LEVEL_COMPLETED:
+                self.advance()
+
+            elif self.stage == Game.VICTORY or self.stage == Game.GAME_OVER:
+                if state & INPUT_RESTART:
+                    self.reset()
 
         if self.stage == Game.PLAYING:
-            if pressed[LEFT]:
+            if state & INPUT_LEFT:
                 self.hero.move_left()
-            elif pressed[RIGHT]:
+            elif state & INPUT_RIGHT:
                 self.hero.move_right()
             else:
                 self.hero.stop()
 
+    def process_events(self):
+        profiler.start("events")
+        state = self.read_input()
+
+        if self.recording is not None:
+            self.recording.append(state)
+
+        self.apply_input(state)
+        profiler.stop("events")
+
 
     def update(self):
         if self.stage == Game.PLAYING:
+            self.level.stream(-self.calculate_offset()[0])
             self.hero.update(self.level)
+
+            profiler.start("enemies")
             self.level.enemies.update(self.level, self.hero)
+            profiler.stop("enemies")
 
         if self.level.completed:
             if self.current_level < len(levels) - 1:
                 self.stage = Game.LEVEL_COMPLETED
             else:
                 self.stage = Game.VICTORY
-            pygame.mixer.music.stop()
+            audio.stop_music()
 
         elif self.hero.lives == 0:
             self.stage = Game.GAME_OVER
-            pygame.mixer.music.stop()
+            audio.stop_music()
 
         elif self.hero.hearts == 0:
             self.level.reset()
             self.hero.respawn(self.level)
 
+        audio.end_frame()
+
     def calculate_offset(self):
-        x = -1 * self.hero.rect.centerx + WIDTH / 2
+        return camera_offset(self.hero, self.level)
+
+    def compose_frame(self):
+        # A frame is a backdrop (the credits, or the level scrolled to an offset) with sprites and the HUD on top
+        if self.stage == Game.VICTORY or self.stage == Game.GAME_OVER:
+            # The credits cover the whole window, so there is no point drawing the level underneath
+            return "credits", [], self.hud()
+
+        offset_x, offset_y = self.calculate_offset()
+
+        return (self.level, offset_x, offset_y), self.viewport.sprites(self.hero, offset_x, offset_y), self.hud()
+
+    def paint(self, backdrop, sprites, hud):
+        profiler.start("draw.layers")
+
+        if backdrop == "credits":
+            self.window.blit(self.credits_screen, (0, 0))
+        else:
+            level, offset_x, offset_y = backdrop
+            level.draw_layers(self.window, offset_x, offset_y)
+            self.viewport.draw_tiles(self.window, offset_x, offset_y)
 
-        if self.hero.rect.centerx < WIDTH / 2:
-            x = 0
-        elif self.hero.rect.centerx > self.level.width - WIDTH / 2:
-            x = -1 * self.level.width + WIDTH
+        for image, position in sprites:
+            self.window.blit(image, position)
 
-        return x, 0
+        profiler.stop("draw.layers")
+        profiler.start("draw.hud")
+
+        for image, position in hud:
+            self.window.blit(image, position)
+
+        profiler.stop("draw.hud")
+
+    def changed_rects(self, frame):
+        # Where this frame differs from the last one shown, or None if it has to be redrawn in full
+        if self.last_frame is None or frame[0] != self.last_frame[0]:
+            return None
+
+        old = self.last_frame[1] + self.last_frame[2]
+        new = frame[1] + frame[2]
+        changed = set(old) ^ set(new)
+
+        # The same things drawn in a different order can still look different where they overlap
+        if len(changed) == 0:
+            changed = set(old)
+
+        window = self.window.get_rect()
+        rects = []
+
+        # Blits drop the fractional part of a position
+        for image, (x, y) in changed:
+            rect = image.get_rect(topleft=(int(x), int(y))).clip(window)
+
+            # Overlapping rects are merged so nothing gets painted twice
+            i = rect.collidelist(rects)
+
+            while i != -1:
+                rect.union_ip(rects.pop(i))
+                i = rect.collidelist(rects)
+
+            if rect.width > 0 and rect.height > 0:
+                rects.append(rect)
+
+        if sum(rect.width * rect.height for rect in rects) > WIDTH * HEIGHT // 2:
+            return None
+
+        return rects
 
     def draw(self):
-        offset_x, offset_y = self.calculate_offset()
+        frame = self.compose_frame()
 
-        self.level.active_layer.fill(TRANSPARENT)
-        self.level.active_sprites.draw(self.level.active_layer)
+        if dirty_rects and not self.show_profile:
+            # Only what changed since the last frame is repainted and sent to the display
+            if frame == self.last_frame:
+                return
 
-        if self.hero.invincibility % 3 < 2:
-            self.level.active_layer.blit(self.hero.image, [self.hero.rect.x, self.hero.rect.y])
+            rects = self.changed_rects(frame)
+        else:
+            rects = None
 
-        self.window.blit(self.level.background_layer, [offset_x / 3, offset_y])
-        self.window.blit(self.level.scenery_layer, [offset_x / 2, offset_y])
-        self.window.blit(self.level.inactive_layer, [offset_x, offset_y])
-        self.window.blit(self.level.active_layer, [offset_x, offset_y])
+        if rects is None:
+            self.paint(*frame)
+        else:
+            for rect in rects:
+                self.window.set_clip(rect)
+                self.paint(*frame)
 
-        self.display_stats(self.window)
+            self.window.set_clip(None)
 
-        if self.stage == Game.SPLASH:
-            self.display_splash(self.window)
-        elif self.stage == Game.START:
-            self.display_message(self.window, "Ready?!!!", "Press any key to start.")
-        elif self.stage == Game.PAUSED:
-            pass
-        elif self.stage == Game.LEVEL_COMPLETED:
-            self.display_message(self.window, "Level Complete", "Press any key to continue.")
-        elif self.stage == Game.VICTORY:
-            self.display_message(self.window, "You Win!", "Press 'R' to restart.")
-        elif self.stage == Game.GAME_OVER:
-            self.display_message(self.window, "Game Over", "Press 'R' to restart.")
+        self.last_frame = frame
+
+        if self.show_profile:
+            profiler.draw_overlay(self.window)
+
+        profiler.start("flip")
 
-        pygame.display.flip()
+        if rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(rects)
+
+        profiler.stop("flip")
+
+        if self.startup_time is None:
+            self.startup_time = time.perf_counter() - LAUNCH_TIME
 
     def loop(self):
         while not self.done:
-            self.process_events()
-            self.update()
+            ticks = self.pacer.ticks()
+            profiler.start("frame")
+
+            for n in range(ticks):
+                self.process_events()
+                self.update()
+
+                if self.done:
+                    break
+
             self.draw()
-            self.clock.tick(FPS)
+            profiler.stop("frame")
+            profiler.end_frame()
+
+    def replay(self, log, realtime=True):
+        pacer = FramePacer(FPS, self.pacer.max_skip, self.pacer.uncapped or not realtime)
+        states = iter(log.states)
+
+        while not self.done:
+            ticks = pacer.ticks()
+            profiler.start("frame")
+            replayed = 0
+
+            for n in range(ticks):
+                state = next(states, None)
+
+                if state is None:
+                    self.done = True
+                    break
+
+                # Only closing the window is taken live, everything else comes from the log
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        self.done = True
+
+                profiler.start("events")
+                self.apply_input(state)
+                profiler.stop("events")
+                self.update()
+                replayed += 1
+
+                if self.done:
+                    break
+
+            if replayed > 0:
+                self.draw()
+
+            profiler.stop("frame")
+            profiler.end_frame()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=TITLE)
+    parser.add_argument("--startup-time", action="store_true",
+                        help="print how long it took to get the first frame on screen")
+    parser.add_argument("--headless", metavar="SCRIPT",
+                        help="play an input script with no window, sound or frame cap and report the result")
+    parser.add_argument("--world", default=levels[0],
+                        help="world file to play with --headless")
+    parser.add_argument("--stream", action="store_true",
+                        help="load worlds in chunks around the camera instead of all at once")
+    parser.add_argument("--batch-enemies", action="store_true",
+                        help="move crowds of enemies with NumPy arrays (needs NumPy)")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="only repaint the parts of the window that changed, and nothing when nothing did")
+    parser.add_argument("--max-frames", type=int,
+                        help="stop a headless run after this many frames")
+    parser.add_argument("--record", metavar="FILE",
+                        help="save this session's input to FILE when the game exits")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="play back a session saved with --record")
+    parser.add_argument("--fast", action="store_true",
+                        help="replay as fast as possible instead of at %d FPS" % FPS)
+    parser.add_argument("--max-skip", type=int, default=max_frame_skip,
+                        help="most draws to skip in a row when the game falls behind %d FPS" % FPS)
+    parser.add_argument("--uncapped", action="store_true",
+                        help="run one update and one draw after another with no frame cap")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="time each part of the frame and save it to FILE on exit (.csv for every frame, otherwise JSON percentiles)")
+    parser.add_argument("--profile-overlay", action="store_true",
+                        help="show frame timing percentiles on screen")
+    args = parser.parse_args()
+
+    profiler.enabled = bool(args.profile or args.profile_overlay)
+    stream_levels = args.stream
+    dirty_rects = args.dirty_rects
+    max_frame_skip = args.max_skip
+    uncapped = args.uncapped
+
+    if args.batch_enemies and numpy is None:
+        parser.error("--batch-enemies needs NumPy")
+
+    batch_enemies = args.batch_enemies
+
+    if args.headless:
+        sim = Simulation(args.world, read_input_script(args.headless), args.stream)
+        outcome = sim.run(args.max_frames)
+
+        print("%s: %s after %d frames, %d deaths, score %d" % (args.world, outcome, sim.frames, sim.deaths, sim.hero.score))
+        print("Simulated %.0f frames per second" % sim.fps())
+
+        if args.profile:
+            profiler.export(args.profile)
+
+        sys.exit()
+
     game = Game()
-    game.start()
-    game.loop()
+    game.show_profile = args.profile_overlay
+
+    if args.replay:
+        start = time.perf_counter()
+        game.replay(InputLog.load(args.replay), not args.fast)
+        print("Replayed in %.2f s" % (time.perf_counter() - start))
+    else:
+        if args.record:
+            game.recording = InputLog()
+
+        game.loop()
+
+        if args.record:
+            game.recording.save(args.record)
+
+    if args.startup_time:
+        print("Startup time: %.3f s" % game.startup_time)
+
+    if args.profile:
+        profiler.export(args.profile)
+
     pygame.quit()
     sys.exit()
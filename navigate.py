@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import heapq
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+import game
+
+NAV_EXTENSION = ".nav"
+NAV_VERSION = 1
+
+# A jump holds its direction from frame start until frame stop after takeoff (to the landing when stop is None).
+# Between them they cover long jumps, short hops onto narrow ledges and going straight up before moving across.
+JUMP_WINDOWS = [(0, None), (0, 6), (0, 12), (0, 20), (8, None), (16, None)]
+
+# Walking off a ledge holds the direction this many frames, or all the way down when None
+FALL_HOLDS = [None, 12, 16, 24]
+
+# A jump or fall that hasn't landed by now is treated as never landing
+MAX_MOVE_FRAMES = 240
+
+# The bot hops when an enemy comes this close, so it comes down on top of it instead of walking into it
+ENEMY_REACH = 48
+
+WALK = "walk"
+JUMP = "jump"
+FALL = "fall"
+
+# Edges are found twice, for the hero at full speed and while a ReducedSpeed pickup has it at half speed
+MODES = {"normal": False, "slowed": True}
+
+Edge = collections.namedtuple("Edge", ["target", "kind", "frames", "direction", "start", "stop"])
+
+# Moves
+def move_inputs(edge):
+    # Frame by frame input for a jump or fall edge, starting from standing still in its cell
+    for frame in itertools.count():
+        state = 0
+
+        if edge.start <= frame and (edge.stop is None or frame < edge.stop):
+            state = edge.direction
+
+        if edge.kind == JUMP and frame == 0:
+            state |= game.INPUT_JUMP
+
+        yield state
+
+def step(hero, level, state):
+    # The part of Simulation.step that moves the hero through the blocks. Enemies and pickups are left out.
+    if state & game.INPUT_JUMP:
+        hero.jump(level.block_shapes)
+
+    if state & game.INPUT_LEFT:
+        hero.move_left()
+    elif state & game.INPUT_RIGHT:
+        hero.move_right()
+    else:
+        hero.stop()
+
+    hero.apply_gravity(level)
+    hero.move_and_process_blocks(level.block_shapes)
+
+    if hero.rect.left < 0:
+        hero.rect.left = 0
+    elif hero.rect.right > level.width:
+        hero.rect.right = level.width
+
+def cell_of(rect, cells):
+    # The standing cell under the hero's middle, or under either of its sides when it hangs over a ledge
+    row = rect.bottom // game.GRID_SIZE - 1
+
+    for col in (rect.centerx // game.GRID_SIZE, rect.left // game.GRID_SIZE, (rect.right - 1) // game.GRID_SIZE):
+        if (col, row) in cells:
+            return (col, row)
+
+    return None
+
+def try_move(hero, level, cells, cell, edge):
+    hero.rect.topleft = (cell[0] * game.GRID_SIZE, cell[1] * game.GRID_SIZE)
+    hero.vx = 0
+    hero.vy = 0
+    airborne = False
+
+    for frame, state in enumerate(itertools.islice(move_inputs(edge), MAX_MOVE_FRAMES), 1):
+        step(hero, level, state)
+
+        if hero.rect.y > level.height:
+            return None
+
+        if not hero.on_ground:
+            airborne = True
+        elif airborne:
+            target = cell_of(hero.rect, cells)
+
+            if target is None or target == cell:
+                return None
+
+            return edge._replace(target=target, frames=frame)
+
+    return None
+
+# Graph
+class NavGraph():
+
+    # Nodes are the cells the hero can stand in: free, with a block right under them. Walk edges join neighbours
+    # on the same floor. Jump and fall edges are found by playing each move from a standing start with the hero's
+    # own physics and seeing where it lands. Edge costs are in frames, and edges[slowed] holds one set per speed.
+    def __init__(self, cells, edges, goals):
+        self.cells = cells
+        self.edges = edges
+        self.goals = goals
+
+    def counts(self, slowed=False):
+        return collections.Counter(edge.kind for edges in self.edges[slowed].values() for edge in edges)
+
+    def plan(self, slowed=False, removed=()):
+        # Dijkstra back from the exit, giving every cell that can reach it the first edge of its quickest route
+        incoming = collections.defaultdict(list)
+
+        for cell, edges in self.edges[slowed].items():
+            for edge in edges:
+                if (cell, edge) not in removed:
+                    incoming[edge.target].append((cell, edge))
+
+        frames = {goal: 0 for goal in self.goals}
+        route = {}
+        queue = [(0, goal) for goal in self.goals]
+        heapq.heapify(queue)
+
+        while queue:
+            cost, cell = heapq.heappop(queue)
+
+            if cost > frames[cell]:
+                continue
+
+            for source, edge in incoming[cell]:
+                total = cost + edge.frames
+
+                if total < frames.get(source, float('inf')):
+                    frames[source] = total
+                    route[source] = edge
+                    heapq.heappush(queue, (total, source))
+
+        return frames, route
+
+def hero_physics():
+    hero = game.Character(game.hero_images)
+
+    return {"grid_size": game.GRID_SIZE, "speed": hero.speed, "jump_power": hero.jump_power}
+
+def find_edges(level, hero, solid, cells, slowed):
+    size = game.GRID_SIZE
+    columns = level.width // size
+    walk_frames = size / (hero.speed / 2 if slowed else hero.speed)
+    edges = {}
+
+    # Nothing here calls hero.update, so the timer stays put for the whole search
+    hero.speed_timer = 1 if slowed else 0
+
+    for cell in sorted(cells):
+        col, row = cell
+        best = {}
+        moves = []
+
+        for direction, dc in ((game.INPUT_LEFT, -1), (game.INPUT_RIGHT, 1)):
+            side = (col + dc, row)
+
+            if side in cells:
+                best[side] = Edge(side, WALK, walk_frames, direction, 0, None)
+            elif side not in solid and 0 <= side[0] < columns:
+                moves += [Edge(None, FALL, None, direction, 0, hold) for hold in FALL_HOLDS]
+
+            moves += [Edge(None, JUMP, None, direction, start, stop) for start, stop in JUMP_WINDOWS]
+
+        moves.append(Edge(None, JUMP, None, 0, 0, None))
+
+        for move in moves:
+            edge = try_move(hero, level, cells, cell, move)
+
+            if edge is not None and (edge.target not in best or edge.frames < best[edge.target].frames):
+                best[edge.target] = edge
+
+        edges[cell] = list(best.values())
+
+    return edges
+
+def build_graph(file_path):
+    level = game.Level(file_path)
+    hero = game.Character(game.hero_images)
+    size = game.GRID_SIZE
+
+    solid = set(level.block_grid.cells)
+    columns = level.width // size
+    cells = set((col, row - 1) for col, row in solid if row > 0 and 0 <= col < columns and (col, row - 1) not in solid)
+
+    exits = [pickup.rect for pickup in level.exit]
+    goals = [cell for cell in cells
+             if game.pygame.Rect(cell[0] * size, cell[1] * size, size, size).collidelist(exits) >= 0]
+
+    edges = {slowed: find_edges(level, hero, solid, cells, slowed) for slowed in MODES.values()}
+
+    return NavGraph(cells, edges, goals)
+
+# Cache
+def nav_path(file_path):
+    return os.path.splitext(file_path)[0] + NAV_EXTENSION
+
+def save_graph(graph, file_path, physics):
+    data = {"version": NAV_VERSION,
+            "sources": [game.file_stamp(file_path)],
+            "physics": physics,
+            "cells": sorted(graph.cells),
+            "goals": graph.goals,
+            "edges": {mode: [[cell, list(edge)] for cell, edges in sorted(graph.edges[slowed].items()) for edge in edges]
+                      for mode, slowed in MODES.items()}}
+    cache_path = nav_path(file_path)
+
+    # A temporary file of its own, as batch.py workers may all be building the same graph
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cache_path) or os.curdir)
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+
+        os.replace(temp_path, cache_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+def read_graph(cache_path, physics):
+    with open(cache_path, 'r') as f:
+        data = json.load(f)
+
+    if data["version"] != NAV_VERSION or data["physics"] != physics:
+        return None
+
+    if not all(game.is_fresh(stamp) for stamp in data["sources"]):
+        return None
+
+    cells = set(tuple(cell) for cell in data["cells"])
+    edges = {}
+
+    for mode, slowed in MODES.items():
+        edges[slowed] = {cell: [] for cell in cells}
+
+        for cell, (target, kind, frames, direction, start, stop) in data["edges"][mode]:
+            edges[slowed][tuple(cell)].append(Edge(tuple(target), kind, frames, direction, start, stop))
+
+    return NavGraph(cells, edges, [tuple(goal) for goal in data["goals"]])
+
+def load_graph(file_path, rebuild=False):
+    physics = hero_physics()
+
+    if not rebuild:
+        try:
+            graph = read_graph(nav_path(file_path), physics)
+
+            if graph is not None:
+                return graph
+        except (OSError, ValueError, KeyError):
+            pass
+
+    graph = build_graph(file_path)
+
+    try:
+        save_graph(graph, file_path, physics)
+    except OSError:
+        pass # Read-only install, build it again next time
+
+    return graph
+
+# Bot
+class Bot():
+
+    # Follows the quickest route to the exit. The next move is looked up afresh every time the hero is standing,
+    # so a stomp on an enemy or a jump that lands short just means carrying on from wherever it ended up.
+    # A move that keeps missing its target is left out of the route until that leaves no route at all.
+    def __init__(self, graph):
+        self.graph = graph
+        self.misses = collections.Counter()
+        self.removed = set()
+        self.routes = {}
+
+    def route(self, slowed):
+        if slowed not in self.routes:
+            self.routes[slowed] = self.graph.plan(slowed, self.removed)[1]
+
+        return self.routes[slowed]
+
+    def inputs(self, sim):
+        hero = sim.hero
+
+        while True:
+            slowed = hero.speed_timer > 0
+            cell = cell_of(hero.rect, self.graph.cells) if hero.on_ground else None
+            edge = self.route(slowed).get(cell)
+
+            if edge is None and cell is not None and len(self.removed) > 0:
+                self.forget()
+                edge = self.route(slowed).get(cell)
+
+            if edge is None:
+                yield 0
+                continue
+
+            offset = cell[0] * game.GRID_SIZE - hero.rect.x
+            step_size = hero.speed / 2 if slowed else hero.speed
+
+            reach = hero.rect.inflate(2 * ENEMY_REACH, 0)
+            near = sim.level.enemies.collide(reach) if hero.invincibility == 0 else []
+
+            if len(near) > 0:
+                # Hop on the spot so whatever walks in underneath gets landed on, or back off while something
+                # is hanging about where the hop would go
+                overhead = reach.inflate(0, hero.jump_power ** 2 / (2 * sim.level.gravity))
+                overhead.bottom = hero.rect.top
+
+                if len(sim.level.enemies.collide(overhead)) > 0:
+                    yield game.INPUT_LEFT if near[0].rect.centerx > hero.rect.centerx else game.INPUT_RIGHT
+                else:
+                    yield game.INPUT_JUMP
+
+                    while not hero.on_ground:
+                        yield 0
+            elif edge.kind == WALK:
+                yield edge.direction
+            elif abs(offset) * 2 > step_size:
+                # Jumps and falls start lined up on their cell, the way they were found
+                yield game.INPUT_RIGHT if offset > 0 else game.INPUT_LEFT
+            else:
+                yield from itertools.islice(move_inputs(edge), edge.frames)
+
+                if cell_of(hero.rect, self.graph.cells) != edge.target:
+                    self.missed(cell, edge)
+
+    def missed(self, cell, edge):
+        self.misses[cell, edge] += 1
+
+        if self.misses[cell, edge] >= 2:
+            self.removed.add((cell, edge))
+            self.routes = {}
+
+    def forget(self):
+        self.misses.clear()
+        self.removed.clear()
+        self.routes = {}
+
+def play(file_path, max_frames=None, streaming=False):
+    sim = game.Simulation(file_path, None, streaming)
+    sim.inputs = Bot(load_graph(file_path)).inputs(sim)
+    sim.run(max_frames)
+
+    return sim
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build navigation graphs for worlds and play them with a shortest-path bot.")
+    parser.add_argument("worlds", nargs="*", default=game.levels,
+                        help="world files (default: every world in the game)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild the graph even when the cached one is up to date")
+    parser.add_argument("--play", action="store_true",
+                        help="let the bot play each world headless and report how it went")
+    parser.add_argument("--max-frames", type=int, default=60 * game.FPS * 5,
+                        help="frame limit for each bot playthrough")
+    args = parser.parse_args()
+
+    failed = False
+
+    for file_path in args.worlds:
+        start = time.perf_counter()
+
+        try:
+            graph = load_graph(file_path, args.rebuild)
+        except (OSError, ValueError, KeyError) as e:
+            print("%s: %s" % (file_path, e), file=sys.stderr)
+            failed = True
+            continue
+
+        loaded = time.perf_counter()
+        frames, route = graph.plan()
+        planned = time.perf_counter()
+
+        counts = graph.counts()
+        level = game.Level(file_path)
+        start_cell = cell_of(game.pygame.Rect(level.start_x, level.start_y, game.GRID_SIZE, game.GRID_SIZE), graph.cells)
+        to_exit = frames.get(start_cell)
+
+        print("%-24s %5d cells %5d walk %5d jump %5d fall  graph %7.1f ms  plan %5.1f ms  exit %s" %
+              (file_path, len(graph.cells), counts[WALK], counts[JUMP], counts[FALL],
+               (loaded - start) * 1000, (planned - loaded) * 1000,
+               "unreachable" if to_exit is None else "%.0f frames" % to_exit))
+
+        if args.play:
+            sim = play(file_path, args.max_frames)
+            print("%-24s bot %s after %d frames, %d deaths, score %d" %
+                  ("", sim.outcome, sim.frames, sim.deaths, sim.hero.score))
+
+            if sim.outcome != "completed":
+                failed = True
+
+    if failed:
+        sys.exit(1)